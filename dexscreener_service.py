@@ -1,28 +1,153 @@
+import asyncio
+import random
 import aiohttp
+import orjson
 import logging
 
+import ttl_cache
+
 logger = logging.getLogger(__name__)
 
 DEXSCREENER_API_URL = "https://api.dexscreener.com"
 
+# TTL (сек) кэша ответов по типам запросов
+TOKEN_PAIRS_TTL = 15
+# Неудачный запрос по адресу (ошибка сети/API) помним недолго: повторные
+# вставки того же адреса не долбят DexScreener, но сбой быстро забывается
+TOKEN_PAIRS_NEGATIVE_TTL = 5
+TRENDING_TTL = 30
+NEW_PAIRS_TTL = 60
+
+# Максимум адресов в одном запросе /latest/dex/tokens/<a1,a2,...>
+TOKENS_BATCH_SIZE = 30
+
+# Одновременно к DexScreener — не больше DEX_CONCURRENCY запросов, чтобы
+# пачка обновлений не упёрлась в лимит. На 429 ждём Retry-After (не дольше
+# RATE_LIMIT_MAX_WAIT сек, плюс случайная добавка) и повторяем один раз
+DEX_CONCURRENCY = 10
+RATE_LIMIT_RETRIES = 1
+RATE_LIMIT_MAX_WAIT = 10
+_dex_sem = asyncio.Semaphore(DEX_CONCURRENCY)
+
 
-async def fetch_json(session: aiohttp.ClientSession, url: str, params: dict | None = None):
+def _request_key(url: str, params: dict | None) -> tuple:
+    return (url, tuple(sorted(params.items())) if params else ())
+
+
+def _retry_after(headers) -> float:
+    """Пауза из заголовка Retry-After (в секундах; дату не разбираем)"""
     try:
-        async with session.get(url, params=params) as resp:
-            resp.raise_for_status()
-            return await resp.json()
+        delay = float(headers.get("Retry-After", 1))
+    except (TypeError, ValueError):
+        delay = 1.0
+    return min(max(delay, 0.0), RATE_LIMIT_MAX_WAIT)
+
+
+async def _get_json(session: aiohttp.ClientSession, url: str, params: dict | None = None):
+    key = _request_key(url, params)
+    try:
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            # условный GET: если данные не менялись, DexScreener ответит 304 без тела
+            headers, cached_data = ttl_cache.validators(key)
+            async with _dex_sem:
+                async with session.get(url, params=params, headers=headers) as resp:
+                    if resp.status == 429 and attempt < RATE_LIMIT_RETRIES:
+                        delay = _retry_after(resp.headers)
+                    else:
+                        if resp.status == 304 and cached_data is not None:
+                            return cached_data
+                        resp.raise_for_status()
+                        data = orjson.loads(await resp.read())
+                        ttl_cache.remember_validators(key, resp.headers, data)
+                        return data
+            # ждём вне семафора: пауза не занимает слот у других запросов
+            logger.warning("DexScreener 429, повтор через %.1f с: %s", delay, url)
+            await asyncio.sleep(delay + random.uniform(0, 0.5))
     except Exception as e:
-        logger.warning(f"DexScreener request error: {e} for {url}")
+        logger.warning("DexScreener request error: %s for %s", e, url)
         return None
 
 
+async def fetch_json(
+    session: aiohttp.ClientSession,
+    url: str,
+    params: dict | None = None,
+    ttl: float = 0,
+    negative_ttl: float = 0,
+):
+    """
+    GET через общий кэш ttl_cache: одинаковые параллельные запросы
+    объединяются в один HTTP-вызов.
+    ttl > 0 — успешный ответ кэшируется на ttl секунд,
+    negative_ttl > 0 — неудачный (None) на negative_ttl секунд.
+    """
+    return await ttl_cache.cached(
+        _request_key(url, params), ttl, lambda: _get_json(session, url, params), negative_ttl
+    )
+
+
 async def get_token_pairs_by_address(session: aiohttp.ClientSession, address: str):
     """
     Аналог dexscreener_token_info/getTokenPairs из плагина.
     Берём все пары по адресу токена.
     """
     url = f"{DEXSCREENER_API_URL}/latest/dex/tokens/{address}"
-    return await fetch_json(session, url)
+    return await fetch_json(
+        session, url, ttl=TOKEN_PAIRS_TTL, negative_ttl=TOKEN_PAIRS_NEGATIVE_TTL
+    )
+
+
+async def get_token_pairs_batch(session: aiohttp.ClientSession, addresses) -> dict[str, list]:
+    """
+    Пары сразу для многих токенов: DexScreener принимает до 30 адресов
+    через запятую, так что N токенов — это ceil(N/30) запросов, а не N.
+    Возвращает {адрес токена: [пары]}; пара попадает к тому адресу,
+    который совпал с её baseToken или quoteToken.
+    В пакетном ответе на токен приходит меньше пар, чем в одиночном запросе,
+    поэтому кэш get_token_pairs_by_address им не подменяем: результат
+    кладётся под отдельный ключ и читается через get_cached_batch_pairs.
+    """
+    wanted = sorted(set(addresses))
+    result: dict[str, list] = {addr: [] for addr in wanted}
+    if not wanted:
+        return result
+
+    # DexScreener сравнивает EVM-адреса без учёта регистра
+    lookup = {addr.lower(): addr for addr in wanted}
+    chunks = [wanted[i:i + TOKENS_BATCH_SIZE] for i in range(0, len(wanted), TOKENS_BATCH_SIZE)]
+    responses = await asyncio.gather(*(
+        # ttl=0: каждый пакет — свежий ответ сети (одинаковые запросы всё равно объединяются),
+        # иначе закэшированный пакет продлевал бы жизнь старых данных
+        fetch_json(session, f"{DEXSCREENER_API_URL}/latest/dex/tokens/{','.join(chunk)}")
+        for chunk in chunks
+    ))
+
+    for data in responses:
+        for pair in (data or {}).get("pairs") or []:
+            for side in ("baseToken", "quoteToken"):
+                token_addr = (pair.get(side) or {}).get("address") or ""
+                addr = lookup.get(token_addr.lower())
+                if addr is not None:
+                    result[addr].append(pair)
+
+    for addr, pairs in result.items():
+        if pairs:
+            ttl_cache.cache_set(_batch_key(addr), pairs, TOKEN_PAIRS_TTL)
+    return result
+
+
+def _batch_key(address: str) -> tuple:
+    return ("dexscreener_batch", address)
+
+
+def get_cached_batch_pairs(address: str) -> list | None:
+    """
+    Пары токена из последнего пакетного обновления, если оно не старше
+    TOKEN_PAIRS_TTL; None — если свежих данных нет.
+    Подходит для сверки цены/объёма по watchlist, но не для выбора лучшей пары:
+    пакетный ответ содержит только часть пар токена.
+    """
+    return ttl_cache.cache_get(_batch_key(address))
 
 
 async def get_trending_pairs(session: aiohttp.ClientSession, timeframe: str = "6h", limit: int = 10):
@@ -32,7 +157,7 @@ async def get_trending_pairs(session: aiohttp.ClientSession, timeframe: str = "6
     """
     url = f"{DEXSCREENER_API_URL}/latest/dex/trending"
     params = {"timeframe": timeframe, "limit": limit}
-    return await fetch_json(session, url)
+    return await fetch_json(session, url, params, ttl=TRENDING_TTL)
 
 
 async def get_new_pairs(session: aiohttp.ClientSession, chain: str | None = None, limit: int = 10):
@@ -43,7 +168,7 @@ async def get_new_pairs(session: aiohttp.ClientSession, chain: str | None = None
     params = {"limit": limit}
     if chain:
         params["chain"] = chain
-    return await fetch_json(session, url)
+    return await fetch_json(session, url, params, ttl=NEW_PAIRS_TTL)
 
 
 def pick_best_pair(data: dict | None):
@@ -55,11 +180,10 @@ def pick_best_pair(data: dict | None):
         return None
 
     pairs = data["pairs"]
-    # сортируем по ликвидности и объёму за 24ч
+    # нужна только лучшая пара по ликвидности и объёму за 24ч — max вместо сортировки
     def score(p):
         liq = (p.get("liquidity") or {}).get("usd", 0) or 0
         vol = (p.get("volume") or {}).get("h24", 0) or 0
         return liq * 2 + vol
 
-    pairs_sorted = sorted(pairs, key=score, reverse=True)
-    return pairs_sorted[0]
+    return max(pairs, key=score, default=None)
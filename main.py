@@ -14,20 +14,36 @@ main.py - КРИПТО-БОТ С WATCHLIST И ИИ (полная версия)
 """
 
 import os
-import json
 import time
+import queue
+import atexit
 import re
 import logging
+import logging.handlers
 import traceback
 import asyncio
 from pathlib import Path
 from typing import Dict, Optional, List
+from contextlib import asynccontextmanager
 from datetime import datetime
-from collections import deque
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from functools import lru_cache, partial, wraps
+from itertools import count, islice
 
 import aiohttp
+import orjson
 from dotenv import load_dotenv
 
+try:
+    # uvloop (libuv) быстрее стандартного цикла asyncio; на Windows его нет
+    import uvloop
+except ImportError:
+    uvloop = None
+
+import dexscreener_service
+import ttl_cache
+
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -35,7 +51,9 @@ from telegram import (
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -55,6 +73,12 @@ SOLANA_RPC = os.getenv("SOLANA_RPC", "https://api.mainnet-beta.solana.com")
 MORALIS_API_KEY = os.getenv("MORALIS_API_KEY", "")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
+# Если задан WEBHOOK_URL — бот принимает апдейты вебхуком вместо polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token; запросы без него PTB отклоняет
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_PATH = "telegram"
 
 AI_PROVIDERS = {
     "groq": {
@@ -71,69 +95,454 @@ AI_PROVIDERS = {
     },
 }
 
+# Ответ ИИ приходит потоком (SSE): сообщение в Telegram правим не чаще раза
+# в AI_STREAM_EDIT_INTERVAL сек; одновременно к одному провайдеру — до AI_CONCURRENCY запросов
+AI_STREAM_EDIT_INTERVAL = 1.0
+# Вопросы про код/контракты в режиме Mix уходят в OpenRouter
+_CODE_RE = re.compile(r"код|contract|script", re.IGNORECASE)
+AI_CONCURRENCY = 4
+_ai_semaphores = {name: asyncio.Semaphore(AI_CONCURRENCY) for name in AI_PROVIDERS}
+
 # ============ НАСТРОЙКИ ============
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Запись в bot.log и в консоль идёт в отдельном потоке QueueListener: event loop
+# только кладёт запись в очередь и не ждёт ни диск, ни stderr.
+# Ротация: 10 МБ × 5 файлов.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_file_handler = logging.handlers.RotatingFileHandler(
+    'bot.log', maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+)
+_log_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# в очередь уходит только текст сообщения — полный формат применяют handler'ы листенера
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+log_listener = logging.handlers.QueueListener(
+    _log_queue, _log_file_handler, _log_stream_handler, respect_handler_level=True
+)
+
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    format=LOG_FORMAT,
     level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[_log_queue_handler],
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Глобальные переменные WATCHLIST
 tracked_tokens: dict[str, dict] = {}
-pending_threshold_input: dict[int, dict] = {}
+pending_threshold_input: OrderedDict[int, "ThresholdState"] = OrderedDict()
 
 # Глобальные переменные ПОРТФЕЛЯ
 user_wallets: dict[int, dict] = {}
-pending_wallet_input: dict[int, dict] = {}
+pending_wallet_input: OrderedDict[int, "WalletState"] = OrderedDict()
+
+# Состояния ввода (pending_*) упорядочены по последнему касанию:
+# размер ограничен, брошенные на полпути удаляет периодическая задача
+PENDING_STATE_MAX = 10_000
+PENDING_STATE_TTL = 3600
+PENDING_REAP_INTERVAL = 300
 
 DATA_FILE = "bot_data.json"
-PORTFOLIO_UPDATE_INTERVAL = 600
-PORTFOLIO_LAST_UPDATE = {}
+WATCHLIST_FILE = "watchlist.json"
+VOLUME_HISTORY_LEN = 200
+BALANCE_HISTORY_LEN = 168
+SAVE_DEBOUNCE_SECONDS = 1.0
+# Портфель пользователя обновляется не чаще раза в PORTFOLIO_UPDATE_INTERVAL сек
+# (список токенов Moralis всё равно кэшируется на MORALIS_TOKENS_TTL);
+# параллельные обновления одного пользователя идут через его lock по одному
+PORTFOLIO_UPDATE_INTERVAL = 60
+_portfolio_locks: dict[int, "UserLock"] = {}
+
+# Апдейты разных пользователей идут параллельно, а одного пользователя —
+# по очереди: два быстрых нажатия не гоняют его состояния ввода наперегонки.
+# Lock живёт, пока его держат или ждут (см. user_lock), — таблицы не растут
+_user_locks: dict[int, "UserLock"] = {}
+
+# Общая HTTP-сессия (keep-alive пул соединений), живёт всё время работы бота.
+# Через неё ходят все запросы: DexScreener, CoinGecko, Solana RPC, Moralis, ИИ
+HTTP_TIMEOUT = 20
+HTTP_USER_AGENT = "my-telegram-bot/1.0"
+http_session: aiohttp.ClientSession | None = None
+
+# TTL (сек) кэша ответов: цены CoinGecko, токены и нативные балансы Moralis
+# (один кошелёк у нескольких пользователей или повторное обновление — из кэша)
+COINGECKO_PRICE_URL = "https://api.coingecko.com/api/v3/simple/price"
+PRICE_TTL = 30
+MORALIS_TOKENS_TTL = 60
+MORALIS_BALANCE_TTL = 45
+
+# Фоновое обновление кэшей: токены из watchlist одним пакетом DexScreener
+# (dexscreener_service.get_cached_batch_pairs), цены монет одним запросом
+# CoinGecko — обработчики читают уже тёплый кэш цен
+CACHE_REFRESH_INTERVAL = dexscreener_service.TOKEN_PAIRS_TTL
+CACHE_REFRESH_COIN_IDS = ("bitcoin", "solana")
+
+# Лимит Moralis в compute units (CU): бесплатный план — 150 CU/сек.
+# Каждый запрос списывает свою стоимость, при нехватке ждём пополнения
+MORALIS_CU_PER_SECOND = 150
+MORALIS_CU = {"/wallets/balance": 5, "/wallets/tokens": 20}
+_moralis_cu_available = float(MORALIS_CU_PER_SECOND)
+_moralis_cu_updated = time.monotonic()
+_moralis_cu_lock = asyncio.Lock()
+
+# Сколько кошельков обновляется одновременно (бережём лимиты Moralis/RPC)
+WALLET_REFRESH_CONCURRENCY = 5
+_wallet_refresh_sem = asyncio.Semaphore(WALLET_REFRESH_CONCURRENCY)
+
+# Сколько апдейтов обрабатывается параллельно: долгий запрос к DexScreener
+# или ИИ одного пользователя не задерживает ответы остальным
+UPDATE_CONCURRENCY = 32
+WEBHOOK_MAX_CONNECTIONS = 100
+# Бот обрабатывает только сообщения и нажатия кнопок — остальные типы
+# апдейтов Telegram даже не присылает
+ALLOWED_UPDATES = ["message", "callback_query"]
+POLLING_TIMEOUT = 30
+# Таймауты запросов к Bot API (сек). Соединения httpx держит открытыми
+# (keep-alive, пул PTB — 256); pool_timeout — сколько ждать свободного
+# соединения, когда все заняты параллельными апдейтами
+TELEGRAM_CONNECT_TIMEOUT = 10
+TELEGRAM_READ_TIMEOUT = 20
+TELEGRAM_POOL_TIMEOUT = 30
+
+# Отложенная запись: изменения кошельков и watchlist копятся в памяти
+# и сбрасываются на диск одним вызовом
+_save_handle: asyncio.TimerHandle | None = None
+_save_task: asyncio.Task | None = None
+_save_lock = asyncio.Lock()
+_data_dirty = False
 
 # ============ ФУНКЦИИ JSON ХРАНИЛИЩА ============
 
+def _json_default(obj):
+    """Сериализация типов, которые orjson не знает (deque истории объёмов)"""
+    if isinstance(obj, deque):
+        return list(obj)
+    raise TypeError
+
+def read_json_file(path: str):
+    """Читает JSON-файл; недописанный .tmp от прерванного сохранения удаляется"""
+    # основной файл при этом цел — os.replace атомарен
+    Path(f"{path}.tmp").unlink(missing_ok=True)
+    return orjson.loads(Path(path).read_bytes())
+
+def dump_json(obj) -> bytes:
+    """Сериализует данные бота в JSON (с отступами, int-ключи допустимы)"""
+    return orjson.dumps(
+        obj,
+        default=_json_default,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS,
+    )
+
+def write_file_atomic(path: str, payload: bytes):
+    """Атомарно записывает файл (через .tmp и os.replace)"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+def _restore_token(info: dict) -> dict:
+    """Восстанавливает int-ключи подписчиков и deque истории после загрузки из JSON"""
+    subs = info.get("subscribers") or {}
+    info["subscribers"] = {int(uid): sub for uid, sub in subs.items()}
+    history = info.get("volume_history")
+    # старый формат: у каждого подписчика своя копия одной и той же истории
+    for sub in info["subscribers"].values():
+        legacy = sub.pop("volume_history", None)
+        if not history and legacy:
+            history = legacy
+    info["volume_history"] = deque(
+        (tuple(x) for x in history or ()),
+        maxlen=VOLUME_HISTORY_LEN,
+    )
+    return info
+
 def load_data():
-    """Загружает данные из bot_data.json"""
+    """Загружает кошельки и watchlist с диска (один раз при запуске)"""
     global user_wallets
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            user_wallets = {int(k): v for k, v in data.items()}
-            logger.info(f"📊 Данные загружены: {len(user_wallets)} пользователей")
+        data = read_json_file(DATA_FILE)
+        user_wallets = {int(k): v for k, v in data.items()}
+        for user_data in user_wallets.values():
+            for wallet in (user_data.get("wallets") or {}).values():
+                _restore_wallet(wallet)
+        logger.info("📊 Данные загружены: %s пользователей", len(user_wallets))
     except FileNotFoundError:
         user_wallets = {}
         logger.info("📊 Новое хранилище создано")
 
+    try:
+        data = read_json_file(WATCHLIST_FILE)
+        tracked_tokens.clear()
+        tracked_tokens.update({addr: _restore_token(info) for addr, info in data.items()})
+        logger.info("🛰 Watchlist загружен: %s токенов", len(tracked_tokens))
+    except FileNotFoundError:
+        pass
+
+def _serialize_data() -> list[tuple[str, bytes]]:
+    """Снимок кошельков (bot_data.json) и watchlist (watchlist.json) в байтах"""
+    return [
+        (DATA_FILE, dump_json(user_wallets)),
+        # токены без подписчиков (просто просмотренные) не сохраняем
+        (WATCHLIST_FILE, dump_json(
+            {addr: info for addr, info in tracked_tokens.items() if info.get("subscribers")}
+        )),
+    ]
+
+def _write_files(files: list[tuple[str, bytes]]):
+    for path, payload in files:
+        write_file_atomic(path, payload)
+
 def save_data():
-    """Сохраняет данные в bot_data.json"""
+    """Сохраняет кошельки и watchlist синхронно (вне event loop)"""
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_wallets, f, indent=2, ensure_ascii=False)
+        _write_files(_serialize_data())
     except Exception as e:
-        logger.error(f"❌ Ошибка сохранения: {e}")
+        logger.error("❌ Ошибка сохранения: %s", e)
+
+async def save_data_async():
+    """Сохраняет кошельки и watchlist, не блокируя event loop на записи файлов"""
+    global _data_dirty
+    try:
+        # сериализуем в потоке loop — словари в этот момент никто не меняет
+        files = _serialize_data()
+        # lock сохраняет порядок записей, если прошлая ещё не закончилась
+        async with _save_lock:
+            await asyncio.to_thread(_write_files, files)
+    except Exception as e:
+        # запись не удалась — изменения остаются несохранёнными: их допишет
+        # следующее сохранение или flush_data() при остановке
+        _data_dirty = True
+        logger.error("❌ Ошибка сохранения: %s", e)
+
+def flush_data():
+    """Сбрасывает накопленные изменения на диск"""
+    global _save_handle, _save_task, _data_dirty
+    _save_handle = None
+    if not _data_dirty:
+        return
+    _data_dirty = False
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        save_data()
+        return
+    _save_task = loop.create_task(save_data_async())
+
+def schedule_save():
+    """Помечает данные изменёнными и планирует запись через SAVE_DEBOUNCE_SECONDS"""
+    global _save_handle, _data_dirty
+    _data_dirty = True
+    if _save_handle is not None:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # вне event loop (например, при остановке) пишем сразу
+        flush_data()
+        return
+    _save_handle = loop.call_later(SAVE_DEBOUNCE_SECONDS, flush_data)
+
+def append_balance_history(wallet: dict, ts: int, usd_value: float):
+    """
+    История баланса — кольцевой буфер на BALANCE_HISTORY_LEN точек:
+    два параллельных списка (hist_ts, hist_usd), hist_head — самая старая точка
+    """
+    hist_ts = wallet.setdefault("hist_ts", [])
+    hist_usd = wallet.setdefault("hist_usd", [])
+    if len(hist_ts) < BALANCE_HISTORY_LEN:
+        hist_ts.append(ts)
+        hist_usd.append(usd_value)
+        return
+    head = wallet.get("hist_head", 0)
+    hist_ts[head] = ts
+    hist_usd[head] = usd_value
+    wallet["hist_head"] = (head + 1) % BALANCE_HISTORY_LEN
+
+def _restore_wallet(wallet: dict) -> dict:
+    """Переводит старую историю (список словарей balance_history) в кольцевой буфер"""
+    legacy = wallet.pop("balance_history", None)
+    if legacy is not None and "hist_ts" not in wallet:
+        legacy = legacy[-BALANCE_HISTORY_LEN:]
+        wallet["hist_ts"] = [int(p.get("timestamp", 0)) for p in legacy]
+        wallet["hist_usd"] = [float(p.get("usd_value", 0)) for p in legacy]
+        wallet["hist_head"] = 0
+    return wallet
 
 def get_user_wallets(user_id: int) -> dict:
     """Получает кошельки пользователя"""
     if user_id not in user_wallets:
         user_wallets[user_id] = {"wallets": {}, "last_update": 0}
-        save_data()
+        schedule_save()
     return user_wallets[user_id]
 
+def find_wallet(user_data: dict, address: str, chain: str) -> str | None:
+    """wallet_id уже добавленного кошелька с тем же адресом в той же сети"""
+    # EVM-адреса регистронезависимы, base58 (Solana) — нет
+    if chain != "solana":
+        address = address.lower()
+    for wallet_id, wallet in user_data["wallets"].items():
+        other = wallet.get("address", "")
+        if chain != "solana":
+            other = other.lower()
+        if other == address and wallet.get("chain") == chain:
+            return wallet_id
+    return None
+
+def new_wallet_id(wallets: dict) -> str:
+    """Свободный wallet_N: после удаления кошелька len+1 может быть занят"""
+    return next(
+        wallet_id
+        for wallet_id in (f"wallet_{i}" for i in count(len(wallets) + 1))
+        if wallet_id not in wallets
+    )
+
+# ============ СОСТОЯНИЯ ВВОДА ============
+
+@dataclass(slots=True)
+class ThresholdState:
+    """Ввод порогов watchlist: для какого адреса ждём число"""
+    pending_volume_for: str | None = None
+    pending_price_for: str | None = None
+    pending_mcap_for: str | None = None
+    pending_multi: str | None = None
+    multi_params: list = field(default_factory=list)
+    multi_step: int = 0
+    touched_at: float = 0.0
+
+    def forget(self, address: str):
+        """Сбрасывает ожидание ввода для удалённого из watchlist адреса"""
+        if self.pending_volume_for == address:
+            self.pending_volume_for = None
+        if self.pending_price_for == address:
+            self.pending_price_for = None
+        if self.pending_mcap_for == address:
+            self.pending_mcap_for = None
+        if self.pending_multi == address:
+            self.pending_multi = None
+
+@dataclass(slots=True)
+class WalletState:
+    """Пошаговое добавление кошелька: address -> chain -> name"""
+    step: str = "address"
+    address: str | None = None
+    chain: str | None = None
+    touched_at: float = 0.0
+
+def put_pending(store: OrderedDict, user_id: int, state: ThresholdState | WalletState):
+    """Сохраняет состояние ввода пользователя; самые старые вытесняются сверх лимита"""
+    state.touched_at = time.monotonic()
+    store[user_id] = state
+    store.move_to_end(user_id)
+    while len(store) > PENDING_STATE_MAX:
+        store.popitem(last=False)
+
+async def reap_pending_states(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue: удаляет состояния ввода, не тронутые дольше PENDING_STATE_TTL"""
+    cutoff = time.monotonic() - PENDING_STATE_TTL
+    for store in (pending_threshold_input, pending_wallet_input):
+        # старые записи всегда в начале — идём, пока не встретим свежую
+        while store:
+            state = next(iter(store.values()))
+            if state.touched_at > cutoff:
+                break
+            store.popitem(last=False)
+
+@dataclass(slots=True)
+class UserLock:
+    """Lock пользователя и число корутин, которые его держат или ждут"""
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    users: int = 0
+
+@asynccontextmanager
+async def user_lock(locks: dict[int, UserLock], user_id: int):
+    """
+    Захватывает lock пользователя из таблицы locks.
+    Последний вышедший удаляет запись: простаивающие lock'и память не занимают
+    """
+    entry = locks.get(user_id)
+    if entry is None:
+        entry = locks[user_id] = UserLock()
+    entry.users += 1
+    try:
+        async with entry.lock:
+            yield
+    finally:
+        entry.users -= 1
+        if not entry.users:
+            del locks[user_id]
+
 # ============ ФУНКЦИИ ПОЛУЧЕНИЯ БАЛАНСА ============
 
-async def get_solana_balance(address: str) -> dict:
-    """Получает баланс кошелька Solana с retry"""
-    rpc_endpoints = [
-        "https://rpc.ankr.com/solana",
-        "https://solana.public-rpc.com",
-        "https://api.mainnet-beta.solana.com",
-    ]
-    
-    for rpc_url in rpc_endpoints:
+async def moralis_throttle(endpoint: str):
+    """Списывает CU за запрос к Moralis; если бюджет исчерпан — ждёт пополнения"""
+    global _moralis_cu_available, _moralis_cu_updated
+    cost = MORALIS_CU[endpoint]
+    # под локом ожидающие обслуживаются по очереди, без гонки за остаток
+    async with _moralis_cu_lock:
+        while True:
+            now = time.monotonic()
+            _moralis_cu_available = min(
+                float(MORALIS_CU_PER_SECOND),
+                _moralis_cu_available + (now - _moralis_cu_updated) * MORALIS_CU_PER_SECOND,
+            )
+            _moralis_cu_updated = now
+            if _moralis_cu_available >= cost:
+                _moralis_cu_available -= cost
+                return
+            await asyncio.sleep((cost - _moralis_cu_available) / MORALIS_CU_PER_SECOND)
+
+async def _fetch_price_usd(coin_id: str) -> float:
+    """Цена монеты в USD с CoinGecko /simple/price (условный GET по ETag/Last-Modified)"""
+    key = ("coingecko", coin_id)
+    headers, cached_price = ttl_cache.validators(key)
+    async with get_session().get(
+        COINGECKO_PRICE_URL,
+        params={"ids": coin_id, "vs_currencies": "usd"},
+        headers=headers,
+    ) as resp:
+        if resp.status == 304 and cached_price is not None:
+            return cached_price
+        resp.raise_for_status()
+        data = orjson.loads(await resp.read())
+        price = float(data[coin_id]["usd"])
+        ttl_cache.remember_validators(key, resp.headers, price)
+    return price
+
+async def refresh_prices_usd(coin_ids) -> dict[str, float]:
+    """Цены нескольких монет одним запросом CoinGecko; результат кладётся в кэш get_price_usd"""
+    async with get_session().get(
+        COINGECKO_PRICE_URL, params={"ids": ",".join(coin_ids), "vs_currencies": "usd"}
+    ) as resp:
+        resp.raise_for_status()
+        data = orjson.loads(await resp.read())
+    prices = {}
+    for coin_id in coin_ids:
+        usd = (data.get(coin_id) or {}).get("usd")
+        if usd is not None:
+            prices[coin_id] = float(usd)
+            ttl_cache.cache_set(("coingecko", coin_id), prices[coin_id], PRICE_TTL)
+    return prices
+
+async def get_price_usd(coin_id: str) -> float:
+    """Цена монеты по id CoinGecko; кэш PRICE_TTL общий для всех пользователей"""
+    return await ttl_cache.cached(
+        ("coingecko", coin_id), PRICE_TTL, lambda: _fetch_price_usd(coin_id)
+    )
+
+SOLANA_RPC_ENDPOINTS = [
+    "https://rpc.ankr.com/solana",
+    "https://solana.public-rpc.com",
+    "https://api.mainnet-beta.solana.com",
+]
+
+async def _get_solana_lamports(address: str) -> int | None:
+    """Баланс кошелька Solana в лампортах; RPC перебираются по очереди"""
+    session = get_session()
+    for rpc_url in SOLANA_RPC_ENDPOINTS:
         try:
             payload = {
                 "jsonrpc": "2.0",
@@ -141,33 +550,93 @@ async def get_solana_balance(address: str) -> dict:
                 "method": "getBalance",
                 "params": [address]
             }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(rpc_url, json=payload, timeout=aiohttp.ClientTimeout(5)) as resp:
-                    data = await resp.json()
-                    if "result" in data:
-                        balance_lamports = data["result"]["value"]
-                        balance_sol = balance_lamports / 1e9
-                        # получи цену SOL
-                        async with session.get("https://api.coingecko.com/api/v3/simple/price?ids=solana&vs_currencies=usd") as price_resp:
-                            price_data = await price_resp.json()
-                            sol_price = price_data.get("solana", {}).get("usd", 0)
-                        return {
-                            "balance": round(balance_sol, 4),
-                            "usd_value": round(balance_sol * sol_price, 2),
-                            "price": sol_price
-                        }
+            async with session.post(rpc_url, json=payload, timeout=aiohttp.ClientTimeout(5)) as resp:
+                data = orjson.loads(await resp.read())
+            if "result" in data:
+                return data["result"]["value"]
         except Exception as e:
-            logger.warning(f"⚠️ RPC {rpc_url} ошибка: {e}")
+            logger.warning("⚠️ RPC %s ошибка: %s", rpc_url, e)
             continue
     
     logger.error("❌ Все RPC endpoints не доступны")
-    return {"balance": 0, "usd_value": 0, "price": 0}
+    return None
+
+async def _get_solana_lamports_batch(addresses: list[str]) -> dict[str, int]:
+    """Балансы нескольких кошельков одним JSON-RPC batch-запросом (массив вызовов)"""
+    payload = [
+        {"jsonrpc": "2.0", "id": i, "method": "getBalance", "params": [address]}
+        for i, address in enumerate(addresses)
+    ]
+    session = get_session()
+    for rpc_url in SOLANA_RPC_ENDPOINTS:
+        try:
+            async with session.post(rpc_url, json=payload, timeout=aiohttp.ClientTimeout(10)) as resp:
+                data = orjson.loads(await resp.read())
+            if not isinstance(data, list):
+                # endpoint не принимает batch — пробуем следующий
+                logger.warning("⚠️ RPC %s не поддерживает batch", rpc_url)
+                continue
+            return {
+                addresses[item["id"]]: item["result"]["value"]
+                for item in data
+                if "result" in item
+            }
+        except Exception as e:
+            logger.warning("⚠️ RPC %s ошибка: %s", rpc_url, e)
+            continue
+    return {}
+
+def _solana_balance_result(balance_lamports: int | None, sol_price: float) -> dict:
+    if balance_lamports is None:
+        return {"balance": 0, "usd_value": 0, "price": 0, "error": True}
+    balance_sol = balance_lamports / 1e9
+    return {
+        "balance": round(balance_sol, 4),
+        "usd_value": round(balance_sol * sol_price, 2),
+        "price": sol_price
+    }
+
+async def _get_sol_price_or_zero() -> float:
+    try:
+        return await get_price_usd("solana")
+    except Exception as e:
+        logger.warning("⚠️ Цена SOL недоступна: %s", e)
+        return 0
+
+async def get_solana_balance(address: str) -> dict:
+    """Получает баланс кошелька Solana с retry"""
+    # баланс и цена SOL независимы — запрашиваем параллельно
+    balance_lamports, sol_price = await asyncio.gather(
+        _get_solana_lamports(address),
+        _get_sol_price_or_zero(),
+    )
+    return _solana_balance_result(balance_lamports, sol_price)
+
+async def get_solana_balances_batch(addresses: list[str]) -> dict[str, dict]:
+    """Балансы нескольких кошельков Solana: один RPC-вызов на всех и одна цена SOL"""
+    lamports, sol_price = await asyncio.gather(
+        _get_solana_lamports_batch(addresses),
+        _get_sol_price_or_zero(),
+    )
+    # что не пришло в batch — добираем одиночными запросами
+    missing = [address for address in addresses if address not in lamports]
+    if missing:
+        singles = await asyncio.gather(*(_get_solana_lamports(address) for address in missing))
+        lamports.update(zip(missing, singles))
+    return {
+        address: _solana_balance_result(lamports.get(address), sol_price)
+        for address in addresses
+    }
+
+def _tf(value) -> float:
+    """Число из ответа API: пустые значения (None, "", 0) дают 0.0"""
+    return float(value) if value else 0.0
 
 async def get_evm_portfolio_moralis(address: str, chain: str = "ethereum") -> dict:
     """Получает EVM-портфель через Moralis Wallet API"""
     if not MORALIS_API_KEY:
         logger.warning("⚠️ MORALIS_API_KEY is missing")
-        return {"balance": 0, "usd_value": 0, "tokens": []}
+        return {"balance": 0, "usd_value": 0, "tokens": [], "error": True}
 
     chain_map = {
         "ethereum": "eth",
@@ -176,81 +645,149 @@ async def get_evm_portfolio_moralis(address: str, chain: str = "ethereum") -> di
     }
     moralis_chain = chain_map.get(chain)
     if not moralis_chain:
-        logger.warning(f"⚠️ Moralis: unsupported chain={chain}")
-        return {"balance": 0, "usd_value": 0, "tokens": []}
+        logger.warning("⚠️ Moralis: unsupported chain=%s", chain)
+        return {"balance": 0, "usd_value": 0, "tokens": [], "error": True}
 
     url_native = f"https://deep-index.moralis.io/api/v2.2/wallets/{address}/balance"
+    url_tokens = f"https://deep-index.moralis.io/api/v2.2/wallets/{address}/tokens"
     headers = {
         "X-API-Key": MORALIS_API_KEY,
         "accept": "application/json",
     }
+    params_native = {"chain": moralis_chain}
+    params_tokens = {
+        "chain": moralis_chain,
+        "exclude_spam": "true",
+    }
+    session = get_session()
+
+    async def fetch_native():
+        await moralis_throttle("/wallets/balance")
+        async with session.get(
+            url_native, params=params_native, headers=headers, timeout=aiohttp.ClientTimeout(15)
+        ) as resp:
+            data = orjson.loads(await resp.read())
+        # ответ об ошибке (без balance) не кэшируем
+        return data if isinstance(data, dict) and "balance" in data else None
+
+    async def fetch_tokens():
+        await moralis_throttle("/wallets/tokens")
+        async with session.get(
+            url_tokens, params=params_tokens, headers=headers, timeout=aiohttp.ClientTimeout(20)
+        ) as resp:
+            data = orjson.loads(await resp.read())
+        return data if isinstance(data, list) else None
+
+    # нативный баланс и токены независимы — запрашиваем параллельно
+    native_data, tokens_data = await asyncio.gather(
+        ttl_cache.cached(("moralis_balance", moralis_chain, address), MORALIS_BALANCE_TTL, fetch_native),
+        ttl_cache.cached(("moralis_tokens", moralis_chain, address), MORALIS_TOKENS_TTL, fetch_tokens),
+        return_exceptions=True,
+    )
 
     native_usd = 0.0
     native_balance = 0.0
-    try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(15)) as session:
-            params_native = {"chain": moralis_chain}
-            async with session.get(url_native, params=params_native, headers=headers) as resp:
-                native_data = await resp.json()
-                native_balance_wei = float(native_data.get("balance") or 0)
-                native_balance = native_balance_wei / 1e18
-                native_usd = float(native_data.get("usd_value") or 0)
-    except Exception as e:
-        logger.error(f"⚠️ Moralis native balance error for {chain} {address}: {e}")
-        native_balance = 0.0
+    # error: часть данных не получена — итог неполный, вызывающий его не применяет
+    failed = False
+    if native_data is None or isinstance(native_data, Exception):
+        logger.error("⚠️ Moralis native balance error for %s %s: %s", chain, address, native_data)
+        failed = True
+    else:
+        try:
+            native_balance_wei = float(native_data.get("balance") or 0)
+            native_balance = native_balance_wei / 1e18
+            native_usd = float(native_data.get("usd_value") or 0)
+        except (TypeError, ValueError) as e:
+            logger.error("⚠️ Moralis native balance error for %s %s: %s", chain, address, e)
+            failed = True
+            native_balance = 0.0
+            native_usd = 0.0
 
-    url_tokens = f"https://deep-index.moralis.io/api/v2.2/wallets/{address}/tokens"
     tokens = []
     tokens_usd = 0.0
-    try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(20)) as session:
-            params_tokens = {
-                "chain": moralis_chain,
-                "exclude_spam": "true",
-            }
-            async with session.get(url_tokens, params=params_tokens, headers=headers) as resp:
-                data = await resp.json()
-                if isinstance(data, list):
-                    for t in data:
-                        try:
-                            symbol = t.get("symbol") or ""
-                            name = t.get("name") or ""
-                            balance = float(t.get("balance_formatted") or t.get("balance") or 0)
-                            usd_value = float(t.get("usd_value") or 0)
-                            tokens_usd += usd_value
-                            tokens.append({
-                                "symbol": symbol,
-                                "name": name,
-                                "balance": balance,
-                                "usd_value": usd_value,
-                            })
-                        except Exception:
-                            continue
-    except Exception as e:
-        logger.error(f"⚠️ Moralis tokens error for {chain} {address}: {e}")
+    if isinstance(tokens_data, Exception):
+        logger.error("⚠️ Moralis tokens error for %s %s: %s", chain, address, tokens_data)
+        failed = True
+    else:
+        for t in tokens_data or []:
+            try:
+                balance = _tf(t.get("balance_formatted") or t.get("balance"))
+                usd_value = _tf(t.get("usd_value"))
+            except (TypeError, ValueError, AttributeError):
+                # битая запись токена — пропускаем её, а не весь портфель
+                continue
+            tokens_usd += usd_value
+            tokens.append({
+                "symbol": t.get("symbol") or "",
+                "name": t.get("name") or "",
+                "balance": balance,
+                "usd_value": usd_value,
+            })
 
     total_usd = native_usd + tokens_usd
-    logger.info(f"Moralis portfolio chain={chain} addr={short_addr(address)} native={native_balance:.4f} tokens_count={len(tokens)} total_usd={total_usd}")
+    logger.debug(
+        "Moralis portfolio chain=%s addr=%s native=%.4f tokens_count=%d total_usd=%s",
+        chain, short_addr(address), native_balance, len(tokens), total_usd,
+    )
 
     return {
         "balance": round(native_balance, 6),
         "usd_value": round(total_usd, 2),
         "tokens": tokens,
+        "error": failed,
     }
 
+# ============ HTTP СЕССИЯ ============
+
+def get_session() -> aiohttp.ClientSession:
+    """Возвращает общую HTTP-сессию, созданную в post_init"""
+    if http_session is None:
+        raise RuntimeError("HTTP-сессия ещё не создана (post_init не выполнен)")
+    return http_session
+
+async def post_init(app: Application):
+    """Создаёт общую HTTP-сессию при старте бота"""
+    global http_session
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=20,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+        ),
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        headers={"User-Agent": HTTP_USER_AGENT},
+        # aiohttp ждёт от json_serialize строку, orjson отдаёт bytes
+        json_serialize=lambda obj: orjson.dumps(obj).decode(),
+    )
+
+async def post_shutdown(app: Application):
+    """Дожидается начатой записи данных и закрывает общую HTTP-сессию"""
+    global http_session
+    if _save_task is not None and not _save_task.done():
+        await _save_task
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
 # ============ DEXSCREENER ФУНКЦИИ ============
 
 async def get_token_pairs_by_address(session: aiohttp.ClientSession, address: str) -> list:
     """Получает все пары токена с DexScreener"""
-    try:
-        url = f"https://api.dexscreener.com/latest/dex/tokens/{address}"
-        async with session.get(url, timeout=aiohttp.ClientTimeout(10)) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                return data.get("pairs", [])
-    except Exception as e:
-        logger.error(f"DexScreener error: {e}")
-    return []
+    data = await dexscreener_service.get_token_pairs_by_address(session, address)
+    return (data or {}).get("pairs") or []
+
+async def refresh_caches(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue: пакетно обновляет пары токенов из watchlist и цены монет"""
+    addresses = [addr for addr, info in tracked_tokens.items() if info.get("subscribers")]
+    results = await asyncio.gather(
+        dexscreener_service.get_token_pairs_batch(get_session(), addresses),
+        refresh_prices_usd(CACHE_REFRESH_COIN_IDS),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("⚠️ Фоновое обновление кэша: %s", result)
 
 def pick_best_pair(pairs: list) -> dict | None:
     """Выбирает лучшую пару (по liquidity и volume)"""
@@ -262,32 +799,58 @@ def pick_best_pair(pairs: list) -> dict | None:
 
 # ============ УТИЛИТЫ ============
 
+# Символы hex-части EVM-адреса
+HEX_CHARS = frozenset("0123456789abcdefABCDEF")
+
+# Алфавит base58 (Solana): без 0, O, I, l
+BASE58_CHARS = frozenset("123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz")
+
+@lru_cache(maxsize=4096)
+def detect_address_kind(address: str) -> str | None:
+    """Определяет тип адреса: "evm", "solana" или None, если адрес некорректный"""
+    # EVM-адрес всегда 0x + 40 символов — длина отсекает его без regex
+    if len(address) == 42 and address[:2] == "0x":
+        return "evm" if HEX_CHARS.issuperset(address[2:]) else None
+    if 32 <= len(address) <= 44 and BASE58_CHARS.issuperset(address):
+        return "solana"
+    return None
+
+@lru_cache(maxsize=4096)
 def short_addr(address: str) -> str:
     """Сокращает адрес"""
     if len(address) <= 10:
         return address
     return f"{address[:4]}...{address[-4:]}"
 
+# chainId DexScreener -> название сети для сообщений
+CHAIN_NAMES = {
+    "solana": "Solana",
+    "eth": "Ethereum",
+    "ethereum": "Ethereum",
+    "bsc": "BSC",
+    "bnb": "BSC",
+    "base": "Base",
+    "polygon": "Polygon",
+    "arbitrum": "Arbitrum",
+    "optimism": "Optimism",
+    "avax": "Avalanche",
+}
+_chain_name_get = CHAIN_NAMES.get
+
+# Значок сети кошелька в списке портфеля
+CHAIN_EMOJI = {"solana": "🟣", "ethereum": "⚪", "base": "🔵", "bsc": "🟡"}
+
 def map_chain(chain_id: str | None) -> str:
-    if not chain_id:
-        return "Unknown"
-    mapping = {
-        "solana": "Solana",
-        "eth": "Ethereum",
-        "ethereum": "Ethereum",
-        "bsc": "BSC",
-        "bnb": "BSC",
-        "base": "Base",
-        "polygon": "Polygon",
-        "arbitrum": "Arbitrum",
-        "optimism": "Optimism",
-        "avax": "Avalanche",
-    }
-    return mapping.get(chain_id.lower(), chain_id)
+    return _chain_name_get(chain_id.lower(), chain_id) if chain_id else "Unknown"
 
 def format_addr_with_meta(address: str, info: dict | None) -> str:
-    symbol = info.get("symbol") if info else None
-    chain = map_chain(info.get("chain")) if info else "Unknown"
+    if not info:
+        return _format_addr(address, None, "Unknown")
+    return _format_addr(address, info.get("symbol"), map_chain(info.get("chain")))
+
+@lru_cache(maxsize=4096)
+def _format_addr(address: str, symbol: str | None, chain: str) -> str:
+    """Подпись токена: адрес (символ, сеть); кэш по значениям, не по dict токена"""
     base = address
     meta = []
     if symbol:
@@ -298,7 +861,17 @@ def format_addr_with_meta(address: str, info: dict | None) -> str:
         return base
     return f"{base} ({', '.join(meta)})"
 
+# Порог в процентах: "5", "2,5", "10.5%"; знак — чтобы на "-5" ответить про > 0
+_PCT_RE = re.compile(r"\s*(-?\d+(?:[.,]\d+)?)\s*%?\s*")
+
+def _parse_pct(text: str) -> float | None:
+    """Число из ввода порога или None, если это не число"""
+    m = _PCT_RE.fullmatch(text)
+    return float(m.group(1).replace(",", ".")) if m else None
+
 def ensure_subscriber(info: dict, user_id: int) -> dict:
+    # история объёмов одинакова для всех подписчиков — храним одну на токен
+    info.setdefault("volume_history", deque(maxlen=VOLUME_HISTORY_LEN))
     subs = info.setdefault("subscribers", {})
     sub = subs.get(user_id)
     if not sub:
@@ -311,43 +884,94 @@ def ensure_subscriber(info: dict, user_id: int) -> dict:
             "last_mcap": None,
             "last_ts": None,
             "last_alert_ts": None,
-            "volume_history": deque(maxlen=200),
         }
         subs[user_id] = sub
+        schedule_save()
     return sub
 
 def detect_pump_dump(history: deque) -> str:
     """Анализирует памп/дамп"""
-    if len(history) < 3:
+    n = len(history)
+    if n < 3:
         return ""
-    recent = list(history)[-5:]
-    buy_vols = [b for _, b, _ in recent]
-    sell_vols = [s for _, _, s in recent]
-    avg_buy = sum(buy_vols) / len(buy_vols) if buy_vols else 0
-    avg_sell = sum(sell_vols) / len(sell_vols) if sell_vols else 0
-    if buy_vols and buy_vols[-1] > avg_buy * 2.5:
+    # последние 5 точек читаем с конца deque, без копии всей истории
+    window = min(n, 5)
+    buy_sum = sell_sum = 0.0
+    for _, b, s in islice(reversed(history), window):
+        buy_sum += b
+        sell_sum += s
+    _, last_buy, last_sell = history[-1]
+    if last_buy * window > buy_sum * 2.5:
         return "📈 Возможный памп (высокий buy объём)"
-    if sell_vols and sell_vols[-1] > avg_sell * 2.5:
+    if last_sell * window > sell_sum * 2.5:
         return "📉 Возможный дамп (высокий sell объём)"
     return ""
 
+# Клавиатура неизменяемая — строим один раз при импорте
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton("➕ Добавить токен"), KeyboardButton("📋 Watchlist")],
+        [KeyboardButton("💼 Мой портфель"), KeyboardButton("📊 Статистика")],
+        [KeyboardButton("🤖 ИИ помощник"), KeyboardButton("🔗 Инструменты")],
+        [KeyboardButton("⚙️ Настройки"), KeyboardButton("❓ Справка")],
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+)
+
+# Сети, в которых можно добавить кошелёк (в нижнем регистре, как в кнопках)
+WALLET_CHAINS = frozenset(("solana", "ethereum", "base", "bsc"))
+
+# Клавиатуры шагов добавления кошелька
+CANCEL_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("Отмена")]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+CHAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton("Solana"), KeyboardButton("Ethereum")],
+        [KeyboardButton("Base"), KeyboardButton("BSC")],
+        [KeyboardButton("Отмена")],
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+
+# Меню портфеля: без кошельков кнопки удаления нет
+_PORTFOLIO_MENU_ROWS = (
+    (InlineKeyboardButton("➕ Добавить кошелек", callback_data="portfolio:add"),),
+    (InlineKeyboardButton("👁️ Просмотреть портфель", callback_data="portfolio:view"),),
+    (InlineKeyboardButton("🔄 Обновить баланс", callback_data="portfolio:refresh"),),
+)
+PORTFOLIO_EMPTY_MENU_KEYBOARD = InlineKeyboardMarkup(_PORTFOLIO_MENU_ROWS)
+PORTFOLIO_MENU_KEYBOARD = InlineKeyboardMarkup(
+    _PORTFOLIO_MENU_ROWS
+    + ((InlineKeyboardButton("🗑 Удалить кошелек", callback_data="portfolio:delete"),),)
+)
+
+# Выбор модели ИИ: набор провайдеров задаётся ключами в .env и не меняется
+_ai_rows = []
+if AI_PROVIDERS["groq"]["key"]:
+    _ai_rows.append([InlineKeyboardButton("🆓 Groq (Llama 3.3)", callback_data="ai:groq")])
+if AI_PROVIDERS["openrouter"]["key"]:
+    _ai_rows.append([InlineKeyboardButton("🆓 OpenRouter Llama", callback_data="ai:openrouter")])
+if len(_ai_rows) > 1:
+    _ai_rows.append([InlineKeyboardButton("🎯 Mix (автовыбор)", callback_data="ai:mix")])
+AI_PROVIDER_KEYBOARD = InlineKeyboardMarkup(_ai_rows)
+
 def main_menu_keyboard() -> ReplyKeyboardMarkup:
     """Главное меню с кнопками"""
-    return ReplyKeyboardMarkup(
-        [
-            [KeyboardButton("➕ Добавить токен"), KeyboardButton("📋 Watchlist")],
-            [KeyboardButton("💼 Мой портфель"), KeyboardButton("📊 Статистика")],
-            [KeyboardButton("🤖 ИИ помощник"), KeyboardButton("🔗 Инструменты")],
-            [KeyboardButton("⚙️ Настройки"), KeyboardButton("❓ Справка")],
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False,
-    )
+    return MAIN_MENU_KEYBOARD
 
 # ============ AI ФУНКЦИИ ============
 
-async def call_text_ai(provider: str, prompt: str) -> str:
-    """Вызов текстовой модели (Groq или OpenRouter)"""
+async def call_text_ai(provider: str, prompt: str, on_partial=None) -> str:
+    """
+    Вызов текстовой модели (Groq или OpenRouter) в режиме stream.
+    on_partial(text) — корутина, получает накопленный ответ не чаще
+    раза в AI_STREAM_EDIT_INTERVAL сек, пока ответ генерируется.
+    """
     cfg = AI_PROVIDERS.get(provider)
     if not cfg or not cfg.get("key"):
         return f"❌ Модель {provider} недоступна (нет API ключа)."
@@ -375,30 +999,74 @@ async def call_text_ai(provider: str, prompt: str) -> str:
         ],
         "temperature": 0.7,
         "max_tokens": 800,
+        "stream": True,
     }
 
+    parts = []
     try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(20)) as session:
-            async with session.post(cfg["url"], headers=headers, json=body) as resp:
-                data = await resp.json()
+        async with _ai_semaphores[provider]:
+            async with get_session().post(
+                cfg["url"],
+                headers=headers,
+                json=body,
+                # total не ограничиваем: поток длинный, важна пауза между чанками;
+                # подключение ограничено как у остальных запросов
+                timeout=aiohttp.ClientTimeout(total=None, connect=HTTP_TIMEOUT, sock_read=20),
+            ) as resp:
+                if resp.status != 200 or resp.content_type != "text/event-stream":
+                    # ошибка или провайдер ответил без stream — обычный JSON
+                    data = orjson.loads(await resp.read())
+                    try:
+                        return data["choices"][0]["message"]["content"]
+                    except (KeyError, IndexError, TypeError):
+                        logger.error("Unexpected AI response %s: %s", provider, data)
+                        return "❌ Не удалось разобрать ответ модели."
+
+                last_edit = time.monotonic()
+                async for raw in resp.content:
+                    line = raw.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == b"[DONE]":
+                        break
+                    try:
+                        chunk = orjson.loads(payload)
+                    except orjson.JSONDecodeError:
+                        # битый кадр пропускаем, остальной ответ не теряем
+                        logger.debug("Bad SSE frame from %s: %.200s", provider, payload)
+                        continue
+                    if not isinstance(chunk, dict):
+                        continue
+                    choices = chunk.get("choices") or [{}]
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if not delta:
+                        continue
+                    parts.append(delta)
+                    now = time.monotonic()
+                    if on_partial is not None and now - last_edit >= AI_STREAM_EDIT_INTERVAL:
+                        last_edit = now
+                        await on_partial("".join(parts))
     except Exception as e:
-        logger.error(f"AI {provider} error: {e}")
+        logger.error("AI %s error: %s", provider, e)
+        if parts:
+            # поток оборвался на середине — отдаём то, что уже пришло
+            return "".join(parts)
         return f"❌ Ошибка запроса к {provider}: {e}"
 
-    try:
-        return data["choices"][0]["message"]["content"]
-    except Exception:
-        logger.error(f"Unexpected AI response {provider}: {data}")
+    if not parts:
+        logger.error("Empty AI stream from %s", provider)
         return "❌ Не удалось разобрать ответ модели."
+    return "".join(parts)
 
-async def get_user_context(user_id: int) -> str:
+def get_user_context(user_id: int) -> str:
     """Контекст по портфелю и watchlist для промпта ИИ"""
     udata = get_user_wallets(user_id)
     wallets = udata.get("wallets", {})
 
-    portfolio_text = ""
+    parts = []
     if wallets:
-        portfolio_text = "📊 **ПОРТФЕЛЬ:**\n"
+        parts.append("📊 **ПОРТФЕЛЬ:**\n")
         total_portfolio_usd = 0.0
         for wallet_id, w in wallets.items():
             chain = w.get("chain", "unknown").upper()
@@ -406,12 +1074,12 @@ async def get_user_context(user_id: int) -> str:
             balance = float(w.get("balance", 0) or 0)
             usd = float(w.get("usd_value", 0) or 0)
             total_portfolio_usd += usd
-            portfolio_text += f" • {name} ({chain}): {balance:.4f} ≈ ${usd:,.2f}\n"
-        portfolio_text += f" **ИТОГО: ${total_portfolio_usd:,.2f}**\n\n"
+            parts.append(f" • {name} ({chain}): {balance:.4f} ≈ ${usd:,.2f}\n")
+        parts.append(f" **ИТОГО: ${total_portfolio_usd:,.2f}**\n\n")
     else:
-        portfolio_text = "📊 **ПОРТФЕЛЬ:** Пуст\n\n"
+        parts.append("📊 **ПОРТФЕЛЬ:** Пуст\n\n")
 
-    watchlist_text = "🛰️ **WATCHLIST:**\n"
+    parts.append("🛰️ **WATCHLIST:**\n")
     has_active_watchlist = False
     for address, info in tracked_tokens.items():
         sub = info.get("subscribers", {}).get(user_id)
@@ -430,29 +1098,32 @@ async def get_user_context(user_id: int) -> str:
                 params.append(f"капа {mt:.1f}%")
             if vt is not None:
                 params.append(f"объём {vt:.1f}%")
-            watchlist_text += f" • {symbol}: {', '.join(params)}\n"
+            parts.append(f" • {symbol}: {', '.join(params)}\n")
 
     if not has_active_watchlist:
-        watchlist_text += " (нет активных отслеживаний)\n"
+        parts.append(" (нет активных отслеживаний)\n")
 
-    return portfolio_text + watchlist_text
+    return "".join(parts)
 
 # ============ КОМАНДЫ ============
 
+START_TEXT = (
+    "🤖 **Привет! Я крипто-бот для отслеживания токенов и портфеля.**\n\n"
+    "📌 **ОСНОВНЫЕ ФУНКЦИИ:**\n"
+    "📋 **Watchlist** — отслеживание токенов с алертами\n"
+    "💼 **Мой портфель** — управление кошельками (Solana, ETH, Base, BSC)\n"
+    "📊 **Статистика** — общая информация\n\n"
+    "⚡ **КОМАНДЫ:**\n"
+    "/watchlist — список отслеживаемых токенов\n"
+    "/unwatch <адрес> — убрать токен\n"
+    "/price — цена BTC\n\n"
+    "Используй кнопки меню внизу!"
+)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"/start от {update.effective_user.id}")
-    load_data()
+    logger.info("/start от %s", update.effective_user.id)
     await update.message.reply_text(
-        "🤖 **Привет! Я крипто-бот для отслеживания токенов и портфеля.**\n\n"
-        "📌 **ОСНОВНЫЕ ФУНКЦИИ:**\n"
-        "📋 **Watchlist** — отслеживание токенов с алертами\n"
-        "💼 **Мой портфель** — управление кошельками (Solana, ETH, Base, BSC)\n"
-        "📊 **Статистика** — общая информация\n\n"
-        "⚡ **КОМАНДЫ:**\n"
-        "/watchlist — список отслеживаемых токенов\n"
-        "/unwatch <адрес> — убрать токен\n"
-        "/price — цена BTC\n\n"
-        "Используй кнопки меню внизу!",
+        START_TEXT,
         reply_markup=main_menu_keyboard(),
         parse_mode="Markdown",
     )
@@ -479,21 +1150,16 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"/price от {update.effective_user.id}")
+    logger.info("/price от %s", update.effective_user.id)
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=usd"
-            ) as resp:
-                data = await resp.json()
-                btc_price = data["bitcoin"]["usd"]
-                await update.message.reply_text(
-                    f"₿ **Bitcoin:** ${btc_price:,.2f}",
-                    reply_markup=main_menu_keyboard(),
-                    parse_mode="Markdown",
-                )
+        btc_price = await get_price_usd("bitcoin")
+        await update.message.reply_text(
+            f"₿ **Bitcoin:** ${btc_price:,.2f}",
+            reply_markup=main_menu_keyboard(),
+            parse_mode="Markdown",
+        )
     except Exception as e:
-        logger.error(f"Ошибка /price: {e}")
+        logger.error("Ошибка /price: %s", e)
         await update.message.reply_text("❌ Ошибка получения цены BTC")
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -610,23 +1276,13 @@ async def ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     short_query = text[:150]
     context.user_data["last_ai_query"] = short_query
 
-    user_ctx = await get_user_context(user_id)
-
-    rows = []
-    if "groq" in active:
-        rows.append([InlineKeyboardButton("🆓 Groq (Llama 3.3)", callback_data="ai:groq")])
-    if "openrouter" in active:
-        rows.append([InlineKeyboardButton("🆓 OpenRouter Llama", callback_data="ai:openrouter")])
-    if len(rows) > 1:
-        rows.append([InlineKeyboardButton("🎯 Mix (автовыбор)", callback_data="ai:mix")])
-
-    keyboard = InlineKeyboardMarkup(rows)
+    user_ctx = get_user_context(user_id)
 
     await update.message.reply_text(
         f"🤖 Запрос: `{text}`\n"
         f"📊 Контекст: {user_ctx}",
         parse_mode="Markdown",
-        reply_markup=keyboard,
+        reply_markup=AI_PROVIDER_KEYBOARD,
     )
 
 async def ai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -635,13 +1291,8 @@ async def ai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = q.data or ""
     user_id = q.from_user.id
 
-    if not data.startswith("ai:"):
-        return
-
-    try:
-        _, provider = data.split(":", 1)
-    except ValueError:
-        await q.answer("Некорректная кнопка.")
+    prefix, _, provider = data.partition(":")
+    if prefix != "ai":
         return
 
     short_query = (context.user_data.get("last_ai_query") or "").strip()
@@ -653,8 +1304,7 @@ async def ai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if provider == "mix":
         has_groq = bool(AI_PROVIDERS.get("groq", {}).get("key"))
         has_or = bool(AI_PROVIDERS.get("openrouter", {}).get("key"))
-        low = short_query.lower()
-        if (("код" in low or "contract" in low or "script" in low) and has_or):
+        if _CODE_RE.search(short_query) and has_or:
             provider = "openrouter"
         elif has_groq:
             provider = "groq"
@@ -667,18 +1317,31 @@ async def ai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer("🤖 Думаю...")
     await q.edit_message_text("🤖 Генерирую ответ...")
 
-    user_ctx = await get_user_context(user_id)
+    user_ctx = get_user_context(user_id)
     full_prompt = f"{user_ctx}\n\nВопрос пользователя: {short_query}"
 
-    answer = await call_text_ai(provider, full_prompt)
+    async def show_partial(text: str):
+        # промежуточный текст без Markdown: незакрытая разметка сломала бы правку
+        try:
+            await q.edit_message_text(f"{text} ▌")
+        except TelegramError as e:
+            logger.debug("AI partial edit skipped: %s", e)
+
+    answer = await call_text_ai(provider, full_prompt, on_partial=show_partial)
 
     label = AI_PROVIDERS.get(provider, {}).get("label", provider)
 
-    await q.edit_message_text(
-        f"**{label}:**\n\n{answer}",
-        parse_mode="Markdown",
-        reply_markup=None,
-    )
+    try:
+        await q.edit_message_text(
+            f"**{label}:**\n\n{answer}",
+            parse_mode="Markdown",
+            reply_markup=None,
+        )
+    except BadRequest as e:
+        # Markdown модели не разобрался — показываем ответ как обычный текст,
+        # иначе пользователь останется с недописанным текстом и курсором ▌
+        logger.debug("AI answer Markdown rejected: %s", e)
+        await q.edit_message_text(f"{label}:\n\n{answer}", reply_markup=None)
 
     context.user_data.pop("awaiting_ai_question", None)
     context.user_data.pop("last_ai_query", None)
@@ -688,18 +1351,11 @@ async def ai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_portfolio_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Главное меню портфеля"""
     user_id = update.effective_user.id
+    message = update.effective_message
     user_data = get_user_wallets(user_id)
     wallets = user_data.get("wallets", {})
 
-    keyboard = [
-        [InlineKeyboardButton("➕ Добавить кошелек", callback_data="portfolio:add")],
-        [InlineKeyboardButton("👁️ Просмотреть портфель", callback_data="portfolio:view")],
-        [InlineKeyboardButton("🔄 Обновить баланс", callback_data="portfolio:refresh")],
-    ]
-
-    if wallets:
-        keyboard.append([InlineKeyboardButton("🗑 Удалить кошелек", callback_data="portfolio:delete")])
-
+    keyboard = PORTFOLIO_MENU_KEYBOARD if wallets else PORTFOLIO_EMPTY_MENU_KEYBOARD
     count = len(wallets)
     text = (
         f"💼 **МОЙ ПОРТФЕЛЬ**\n\n"
@@ -707,7 +1363,7 @@ async def show_portfolio_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"Что хочешь сделать?"
     )
 
-    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await message.reply_text(text, reply_markup=keyboard, parse_mode="Markdown")
 
 async def view_portfolio_full(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Просмотр полного портфеля"""
@@ -723,7 +1379,7 @@ async def view_portfolio_full(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return
 
-    text = "💼 **Твой ПОРТФЕЛЬ:**\n\n"
+    parts = ["💼 **Твой ПОРТФЕЛЬ:**\n\n"]
     total_usd = 0
 
     for wallet_id, wallet_info in wallets.items():
@@ -734,24 +1390,25 @@ async def view_portfolio_full(update: Update, context: ContextTypes.DEFAULT_TYPE
         usd = wallet_info.get("usd_value", 0)
         total_usd += usd
 
-        emoji = {"solana": "🟣", "ethereum": "⚪", "base": "🔵", "bsc": "🟡"}.get(chain, "💫")
+        emoji = CHAIN_EMOJI.get(chain, "💫")
 
-        text += f"{emoji} **{name}** ({chain.upper()})\n"
-        text += f" 💰 {balance:.4f} | ${usd:,.2f}\n"
-        text += f" {short_addr(addr)}\n\n"
+        parts.append(f"{emoji} **{name}** ({chain.upper()})\n")
+        parts.append(f" 💰 {balance:.4f} | ${usd:,.2f}\n")
+        parts.append(f" {short_addr(addr)}\n\n")
 
-    text += f"**━━━━━━━━━━━━━━━━━━━━**\n"
-    text += f"**ИТОГО: ${total_usd:,.2f}**"
+    parts.append("**━━━━━━━━━━━━━━━━━━━━**\n")
+    parts.append(f"**ИТОГО: ${total_usd:,.2f}**")
+    text = "".join(parts)
 
     await message.reply_text(text, reply_markup=main_menu_keyboard(), parse_mode="Markdown")
 
-async def update_wallet_balance(user_id: int, wallet_id: str):
-    """Обновляет баланс кошелька"""
+async def update_wallet_balance(user_id: int, wallet_id: str) -> bool:
+    """Обновляет баланс кошелька; False — если баланс получить не удалось"""
     user_data = get_user_wallets(user_id)
     wallet = user_data["wallets"].get(wallet_id)
 
     if not wallet:
-        return
+        return False
 
     address = wallet["address"]
     chain = wallet["chain"]
@@ -761,28 +1418,82 @@ async def update_wallet_balance(user_id: int, wallet_id: str):
     else:
         balance_data = await get_evm_portfolio_moralis(address, chain)
 
+    return apply_wallet_balance(wallet, balance_data)
+
+def apply_wallet_balance(wallet: dict, balance_data: dict) -> bool:
+    """
+    Записывает свежий баланс в кошелёк и дополняет историю.
+    Неудачный запрос (error) не затирает прошлый баланс нулями; возвращает False
+    """
+    if balance_data.get("error"):
+        return False
     wallet["balance"] = balance_data.get("balance", 0)
     wallet["usd_value"] = balance_data.get("usd_value", 0)
     wallet["last_updated"] = int(time.time())
-
-    if "balance_history" not in wallet:
-        wallet["balance_history"] = []
-
-    wallet["balance_history"].append({
-        "timestamp": int(time.time()),
-        "usd_value": wallet["usd_value"]
-    })
-
-    if len(wallet["balance_history"]) > 168:
-        wallet["balance_history"] = wallet["balance_history"][-168:]
-
-    save_data()
+    append_balance_history(wallet, wallet["last_updated"], wallet["usd_value"])
+    schedule_save()
+    return True
+
+async def refresh_user_wallets(user_id: int) -> bool:
+    """
+    Обновляет балансы всех кошельков пользователя параллельно.
+    Возвращает False, если портфель обновлялся меньше PORTFOLIO_UPDATE_INTERVAL сек
+    назад (в том числе параллельным вызовом, пока этот ждал lock) или если
+    не удалось получить ни одного баланса — тогда интервал не отсчитывается
+    и можно сразу повторить.
+    """
+    async with user_lock(_portfolio_locks, user_id):
+        user_data = get_user_wallets(user_id)
+        if time.time() - user_data.get("last_update", 0) < PORTFOLIO_UPDATE_INTERVAL:
+            return False
+        if not await _refresh_wallets(user_id, user_data.get("wallets", {})):
+            return False
+        user_data["last_update"] = int(time.time())
+        schedule_save()
+        return True
+
+async def _refresh_wallets(user_id: int, wallets: dict) -> bool:
+    """
+    Запрашивает балансы кошельков; ошибки отдельных кошельков только логируются.
+    Возвращает True, если обновился хотя бы один кошелёк
+    """
+    # Solana-кошельки обновляются одним batch-запросом, остальные — по одному
+    solana_ids = [wid for wid, w in wallets.items() if w.get("chain") == "solana"]
+    wallet_ids = [wid for wid, w in wallets.items() if w.get("chain") != "solana"]
+
+    async def refresh_one(wallet_id: str) -> bool:
+        async with _wallet_refresh_sem:
+            return await update_wallet_balance(user_id, wallet_id)
+
+    async def refresh_solana():
+        async with _wallet_refresh_sem:
+            balances = await get_solana_balances_batch(
+                list({wallets[wid]["address"] for wid in solana_ids})
+            )
+        updated = False
+        for wid in solana_ids:
+            wallet = wallets.get(wid)
+            if wallet is not None and apply_wallet_balance(wallet, balances[wallet["address"]]):
+                updated = True
+        return updated
+
+    tasks = [refresh_one(wallet_id) for wallet_id in wallet_ids]
+    if solana_ids:
+        tasks.append(refresh_solana())
+        wallet_ids.append("solana")
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for wallet_id, result in zip(wallet_ids, results):
+        if isinstance(result, Exception):
+            logger.error("❌ Ошибка обновления %s у %s: %s", wallet_id, user_id, result)
+    return any(result is True for result in results)
 
 # ============ WATCHLIST КОМАНДЫ ============
 
 async def watchlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Просмотр Watchlist"""
     user_id = update.effective_user.id
+    message = update.effective_message
     items_active = []
     items_disabled = []
 
@@ -816,7 +1527,7 @@ async def watchlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
             items_disabled.append((address, btn_text, "menu_disabled"))
 
     if not items_active and not items_disabled:
-        await update.message.reply_text(
+        await message.reply_text(
             "👀 Сейчас ты ничего не отслеживаешь.",
             reply_markup=main_menu_keyboard(),
         )
@@ -842,7 +1553,7 @@ async def watchlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = InlineKeyboardMarkup(keyboard_buttons)
     text = "🛰 **Твой Watchlist:**\n\nНажми на токен для управления:"
 
-    await update.message.reply_text(text, reply_markup=keyboard, parse_mode="Markdown")
+    await message.reply_text(text, reply_markup=keyboard, parse_mode="Markdown")
 
 async def unwatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Удалить токен из watchlist"""
@@ -869,18 +1580,12 @@ async def unwatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if not info["subscribers"]:
         tracked_tokens.pop(address, None)
+    schedule_save()
 
     state = pending_threshold_input.get(user_id)
-    if state:
-        if state.get("pending_volume_for") == address:
-            state["pending_volume_for"] = None
-        if state.get("pending_price_for") == address:
-            state["pending_price_for"] = None
-        if state.get("pending_mcap_for") == address:
-            state["pending_mcap_for"] = None
-        if state.get("pending_multi") == address:
-            state["pending_multi"] = None
-        pending_threshold_input[user_id] = state
+    if state is not None:
+        state.forget(address)
+        put_pending(pending_threshold_input, user_id, state)
 
     label = format_addr_with_meta(address, info or {})
 
@@ -891,57 +1596,79 @@ async def unwatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ============ ОБРАБОТКА СООБЩЕНИЙ ============
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    text = (update.message.text or "").strip()
-
-    logger.info(f"MSG от {user_id}: {text[:80]}")
-
-    # ========== КНОПКИ ГЛАВНОГО МЕНЮ ==========
-    if text == "📋 Watchlist":
-        await watchlist(update, context)
-        return
+def serialized_per_user(handler):
+    """Обработчик апдейта выполняется под lock'ом пользователя из _user_locks"""
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with user_lock(_user_locks, update.effective_user.id):
+            return await handler(update, context)
+    return wrapper
 
-    if text == "🤖 ИИ помощник":
-        context.user_data["awaiting_ai_question"] = True
-        await update.message.reply_text(
-            "🤖 Напиши свой вопрос для ИИ.\n"
-            "Можешь без /ai, просто текст.\n"
-            "Например: `проанализируй мой портфель и риски`.",
-            parse_mode="Markdown",
-            reply_markup=main_menu_keyboard(),
-        )
-        return
+async def _menu_ai_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["awaiting_ai_question"] = True
+    await update.message.reply_text(
+        "🤖 Напиши свой вопрос для ИИ.\n"
+        "Можешь без /ai, просто текст.\n"
+        "Например: `проанализируй мой портфель и риски`.",
+        parse_mode="Markdown",
+        reply_markup=main_menu_keyboard(),
+    )
 
-    if text == "💼 Мой портфель":
-        await show_portfolio_menu(update, context)
-        return
+async def _menu_add_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "📍 Отправь адрес контракта токена, который хочешь отслеживать.\n\n"
+        "Примеры:\n"
+        "• Solana: EPjFWdd5AufqSSqeM2qN1xzybapC8G4wEGGkZwyTDt1v (USDC)\n"
+        "• Ethereum: 0xdAC17F958D2ee523a2206206994597C13D831ec7 (USDT)\n"
+        "• Base: 0x833589fCD6eDb6E08f4c7C32D4f71b1566dA3633 (USDC)",
+        reply_markup=main_menu_keyboard(),
+    )
 
-    if text == "❓ Справка":
-        await help_cmd(update, context)
-        return
+# Кнопки под анализом токена: как и меню токена в watchlist,
+# собираются один раз на адрес (популярные токены присылают снова и снова)
+@lru_cache(maxsize=1024)
+def _address_keyboard(address: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton("📈 Цена", callback_data=f"select_price:{address}"),
+                InlineKeyboardButton("📊 Капа", callback_data=f"select_mcap:{address}"),
+            ],
+            [
+                InlineKeyboardButton("🛰 Объём m5", callback_data=f"select_vol:{address}"),
+            ],
+            [
+                InlineKeyboardButton("⚙️ Все параметры", callback_data=f"select_all:{address}"),
+            ],
+            [
+                InlineKeyboardButton("🤖 Спросить ИИ", callback_data=f"askai:{address}"),
+            ],
+        ]
+    )
 
-    if text == "📊 Статистика":
-        await stats(update, context)
-        return
+# Кнопки главного меню: текст кнопки -> обработчик
+MENU_HANDLERS = {
+    "📋 Watchlist": watchlist,
+    "🤖 ИИ помощник": _menu_ai_prompt,
+    "💼 Мой портфель": show_portfolio_menu,
+    "❓ Справка": help_cmd,
+    "📊 Статистика": stats,
+    "🔗 Инструменты": tools,
+    "⚙️ Настройки": settings,
+    "➕ Добавить токен": _menu_add_token,
+}
 
-    if text == "🔗 Инструменты":
-        await tools(update, context)
-        return
+@serialized_per_user
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    text = (update.message.text or "").strip()
 
-    if text == "⚙️ Настройки":
-        await settings(update, context)
-        return
+    logger.info("MSG от %s: %.80s", user_id, text)
 
-    if text == "➕ Добавить токен":
-        await update.message.reply_text(
-            "📍 Отправь адрес контракта токена, который хочешь отслеживать.\n\n"
-            "Примеры:\n"
-            "• Solana: EPjFWaLb3odcccccccccccccccccccccccccccccccccc\n"
-            "• Ethereum: 0xdAC17F958D2ee523a2206206994597C13D831ec7 (USDT)\n"
-            "• Base: 0x833589fCD6eDb6E08f4c7C32D4f71b1566dA3633 (USDC)",
-            reply_markup=main_menu_keyboard(),
-        )
+    # ========== КНОПКИ ГЛАВНОГО МЕНЮ ==========
+    menu_handler = MENU_HANDLERS.get(text)
+    if menu_handler is not None:
+        await menu_handler(update, context)
         return
 
     # ========== ЖДЁМ ВОПРОС ДЛЯ ИИ ==========
@@ -960,72 +1687,61 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Отмена", reply_markup=main_menu_keyboard())
             return
 
-        if state.get("step") == "address":
-            if len(text) < 30:
+        if state.step == "address":
+            if detect_address_kind(text) is None:
                 await update.message.reply_text(
-                    "❌ Адрес слишком короткий. Проверь и отправь снова.",
+                    "❌ Некорректный адрес кошелька. Проверь и отправь снова.",
                     reply_markup=main_menu_keyboard()
                 )
                 return
 
-            state["address"] = text
-            state["step"] = "chain"
-
-            keyboard = ReplyKeyboardMarkup(
-                [
-                    [KeyboardButton("Solana"), KeyboardButton("Ethereum")],
-                    [KeyboardButton("Base"), KeyboardButton("BSC")],
-                    [KeyboardButton("Отмена")]
-                ],
-                resize_keyboard=True,
-                one_time_keyboard=True
-            )
+            state.address = text
+            state.step = "chain"
+            put_pending(pending_wallet_input, user_id, state)
 
             await update.message.reply_text(
                 "🌐 Выбери сеть кошелька:",
-                reply_markup=keyboard
+                reply_markup=CHAIN_KEYBOARD
             )
             return
 
-        if state.get("step") == "chain":
-            chain_map = {
-                "solana": "solana",
-                "ethereum": "ethereum",
-                "base": "base",
-                "bsc": "bsc"
-            }
-
-            chain = chain_map.get(text.lower())
+        if state.step == "chain":
+            chain = text.lower()
 
-            if not chain:
+            if chain not in WALLET_CHAINS:
                 await update.message.reply_text(
                     "❌ Выбери из предложенных вариантов.",
                     reply_markup=main_menu_keyboard()
                 )
                 return
 
-            state["chain"] = chain
-            state["step"] = "name"
+            existing = find_wallet(get_user_wallets(user_id), state.address, chain)
+            if existing is not None:
+                pending_wallet_input.pop(user_id, None)
+                name = get_user_wallets(user_id)["wallets"][existing].get("name", "")
+                await update.message.reply_text(
+                    f"ℹ️ Этот кошелек уже добавлен: {name}",
+                    reply_markup=main_menu_keyboard()
+                )
+                return
 
-            keyboard = ReplyKeyboardMarkup(
-                [[KeyboardButton("Отмена")]],
-                resize_keyboard=True,
-                one_time_keyboard=True
-            )
+            state.chain = chain
+            state.step = "name"
+            put_pending(pending_wallet_input, user_id, state)
 
             await update.message.reply_text(
                 "📝 Введи название для этого кошелька (например: 'Основной', 'Trading'):",
-                reply_markup=keyboard
+                reply_markup=CANCEL_KEYBOARD
             )
             return
 
-        if state.get("step") == "name":
-            address = state["address"]
-            chain = state["chain"]
+        if state.step == "name":
+            address = state.address
+            chain = state.chain
             name = text if text != "Отмена" else chain.capitalize()
 
             user_data = get_user_wallets(user_id)
-            wallet_id = f"wallet_{len(user_data['wallets']) + 1}"
+            wallet_id = new_wallet_id(user_data["wallets"])
 
             user_data["wallets"][wallet_id] = {
                 "address": address,
@@ -1034,10 +1750,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "added_at": int(time.time()),
                 "balance": 0,
                 "usd_value": 0,
-                "balance_history": []
+                "hist_ts": [],
+                "hist_usd": [],
+                "hist_head": 0,
             }
+            # новый кошелёк — следующее обновление не должно ждать интервала
+            user_data["last_update"] = 0
 
-            save_data()
+            schedule_save()
             pending_wallet_input.pop(user_id, None)
 
             await update.message.reply_text(
@@ -1053,24 +1773,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
     # ========== WATCHLIST: ВВОД ПОРОГОВ ==========
-    state = pending_threshold_input.get(user_id) or {
-        "pending_volume_for": None,
-        "pending_price_for": None,
-        "pending_mcap_for": None,
-        "pending_multi": None,
-        "multi_params": [],
-        "multi_step": 0,
-    }
+    state = pending_threshold_input.get(user_id)
 
     # МНОЖЕСТВЕННЫЙ ВВОД ПАРАМЕТРОВ
-    if state.get("pending_multi"):
-        address = state["pending_multi"]
-        multi_params = state.get("multi_params", [])
-        multi_step = state.get("multi_step", 0)
+    if state is not None and state.pending_multi:
+        address = state.pending_multi
+        multi_params = state.multi_params
+        multi_step = state.multi_step
 
-        try:
-            threshold = float(text.replace(",", "."))
-        except ValueError:
+        threshold = _parse_pct(text)
+        if threshold is None:
             await update.message.reply_text(
                 "❌ Не понял число. Введи %, например: 5",
                 reply_markup=main_menu_keyboard(),
@@ -1114,8 +1826,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             sub["vol_threshold"] = threshold
             multi_step = 3
 
-        state["multi_step"] = multi_step
-        pending_threshold_input[user_id] = state
+        state.multi_step = multi_step
+        put_pending(pending_threshold_input, user_id, state)
+        schedule_save()
 
         if multi_step >= 3:
             label = format_addr_with_meta(address, info)
@@ -1132,10 +1845,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=main_menu_keyboard(),
             )
 
-            state["pending_multi"] = None
-            state["multi_params"] = []
-            state["multi_step"] = 0
-            pending_threshold_input[user_id] = state
+            state.pending_multi = None
+            state.multi_params = []
+            state.multi_step = 0
+            put_pending(pending_threshold_input, user_id, state)
             return
 
         next_param = None
@@ -1154,16 +1867,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ========== ЕСЛИ ЭТО АДРЕС ТОКЕНА ==========
     address = text
 
+    # не похоже на адрес — не тратим запрос к DexScreener
+    if detect_address_kind(address) is None:
+        await update.message.reply_text(
+            "❌ Не похоже на адрес токена. Отправь адрес контракта (Solana или EVM).",
+            reply_markup=main_menu_keyboard(),
+        )
+        return
+
     await update.message.reply_text(
         f"🔍 Анализирую {address[:12]}...", reply_markup=main_menu_keyboard()
     )
 
     try:
-        async with aiohttp.ClientSession() as session:
-            raw = await get_token_pairs_by_address(session, address)
-            pair = pick_best_pair(raw)
+        raw = await get_token_pairs_by_address(get_session(), address)
+        pair = pick_best_pair(raw)
     except Exception as e:
-        logger.error(f"Ошибка запроса токена {address}: {e}")
+        logger.error("Ошибка запроса токена %s: %s", address, e)
         await update.message.reply_text(
             "❌ Ошибка запроса токена.", reply_markup=main_menu_keyboard()
         )
@@ -1213,476 +1933,445 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🔗 [DexScreener]({pair['url']})"
     )
 
-    keyboard = InlineKeyboardMarkup(
-        [
-            [
-                InlineKeyboardButton("📈 Цена", callback_data=f"select_price:{address}"),
-                InlineKeyboardButton("📊 Капа", callback_data=f"select_mcap:{address}"),
-            ],
-            [
-                InlineKeyboardButton("🛰 Объём m5", callback_data=f"select_vol:{address}"),
-            ],
-            [
-                InlineKeyboardButton("⚙️ Все параметры", callback_data=f"select_all:{address}"),
-            ],
-            [
-                InlineKeyboardButton("🤖 Спросить ИИ", callback_data=f"askai:{address}"),
-            ],
-        ]
+    await update.message.reply_text(
+        text_resp, reply_markup=_address_keyboard(address), parse_mode="Markdown"
     )
 
-    await update.message.reply_text(text_resp, reply_markup=keyboard, parse_mode="Markdown")
-
 # ============ CALLBACK HANDLER ============
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _cb_portfolio_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data or ""
-    user_id = query.from_user.id
-
-    logger.info(f"BTN от {user_id}: {data}")
+    await query.message.reply_text(
+        "📍 Отправь адрес кошелька (Solana, Ethereum, Base или BSC):",
+        reply_markup=CANCEL_KEYBOARD
+    )
+    put_pending(pending_wallet_input, query.from_user.id, WalletState())
 
-    await query.answer()
+async def _cb_portfolio_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    user_data = get_user_wallets(user_id)
+    wallets = user_data.get("wallets", {})
 
-    # ============ ПОРТФЕЛЬ CALLBACKS ============
+    if not wallets:
+        await query.message.reply_text("💼 Портфель пуст!")
+        return
 
-    if data == "portfolio:add":
-        keyboard = ReplyKeyboardMarkup(
-            [[KeyboardButton("Отмена")]],
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
+    age = int(time.time() - user_data.get("last_update", 0))
+    if age < PORTFOLIO_UPDATE_INTERVAL:
         await query.message.reply_text(
-            "📍 Отправь адрес кошелька (Solana, Ethereum, Base или BSC):",
-            reply_markup=keyboard
+            f"ℹ️ Балансы обновлялись {age} сек назад, следующее обновление — "
+            f"через {PORTFOLIO_UPDATE_INTERVAL - age} сек. Показываю текущие."
         )
-        pending_wallet_input[user_id] = {"step": "address"}
-        return
-
-    if data == "portfolio:view":
-        await view_portfolio_full(update, context)
-        return
-
-    if data == "portfolio:refresh":
-        user_data = get_user_wallets(user_id)
-        wallets = user_data.get("wallets", {})
-
-        if not wallets:
-            await query.message.reply_text("💼 Портфель пуст!")
-            return
-
+    else:
         await query.message.reply_text("🔄 Обновляю балансы... (это может занять 30 сек)")
+        # False при свежем last_update — пока ждали lock, портфель обновил
+        # параллельный запрос; при старом — ни один баланс получить не удалось
+        refreshed = await refresh_user_wallets(user_id)
+        if not refreshed and time.time() - user_data.get("last_update", 0) >= PORTFOLIO_UPDATE_INTERVAL:
+            await query.message.reply_text(
+                "⚠️ Не удалось обновить балансы, показываю последние известные. Попробуй ещё раз."
+            )
 
-        for wallet_id in wallets:
-            await update_wallet_balance(user_id, wallet_id)
+    await view_portfolio_full(update, context)
 
-        await view_portfolio_full(update, context)
-        return
+async def _cb_portfolio_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_data = get_user_wallets(query.from_user.id)
+    wallets = user_data.get("wallets", {})
 
-    if data == "portfolio:back":
-        await show_portfolio_menu(update, context)
+    if not wallets:
+        await query.message.reply_text("💼 Нет кошельков для удаления!")
         return
 
-    if data == "portfolio:delete":
-        user_data = get_user_wallets(user_id)
-        wallets = user_data.get("wallets", {})
-
-        if not wallets:
-            await query.message.reply_text("💼 Нет кошельков для удаления!")
-            return
-
-        keyboard = []
-        for wallet_id, wallet_info in wallets.items():
-            name = wallet_info.get("name", "")
-            keyboard.append(
-                [InlineKeyboardButton(f"🗑️ {name}", callback_data=f"wallet_delete:{wallet_id}")]
-            )
-        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="portfolio:back")])
-
-        await query.edit_message_text(
-            text="🗑️ Выбери кошелек для удаления:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+    keyboard = []
+    for wallet_id, wallet_info in wallets.items():
+        name = wallet_info.get("name", "")
+        keyboard.append(
+            [InlineKeyboardButton(f"🗑️ {name}", callback_data=f"wallet_delete:{wallet_id}")]
         )
-        return
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="portfolio:back")])
 
-    if data.startswith("wallet_delete:"):
-        wallet_id = data.split(":", 1)[1]
-        user_data = get_user_wallets(user_id)
+    await query.edit_message_text(
+        text="🗑️ Выбери кошелек для удаления:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-        if wallet_id in user_data["wallets"]:
-            del user_data["wallets"][wallet_id]
-            save_data()
-            await query.message.reply_text("✅ Кошелек удален!")
-            await show_portfolio_menu(update, context)
-        return
+# Кнопки с фиксированным callback_data — один поиск в dict вместо цепочки if
+CALLBACK_HANDLERS = {
+    "portfolio:add": _cb_portfolio_add,
+    "portfolio:view": view_portfolio_full,
+    "portfolio:refresh": _cb_portfolio_refresh,
+    "portfolio:back": show_portfolio_menu,
+    "portfolio:delete": _cb_portfolio_delete,
+    "back_to_watchlist": watchlist,
+}
 
-    # ============ WATCHLIST CALLBACKS ============
+async def _cb_wallet_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, wallet_id: str):
+    query = update.callback_query
+    user_id = query.from_user.id
+    user_data = get_user_wallets(user_id)
 
-    state = pending_threshold_input.get(user_id) or {
-        "pending_volume_for": None,
-        "pending_price_for": None,
-        "pending_mcap_for": None,
-        "pending_multi": None,
-        "multi_params": [],
-        "multi_step": 0,
-    }
+    if wallet_id in user_data["wallets"]:
+        del user_data["wallets"][wallet_id]
+        schedule_save()
+        await query.message.reply_text("✅ Кошелек удален!")
+        await show_portfolio_menu(update, context)
 
-    if data.startswith("select_all:"):
-        address = data.split(":", 1)[1]
-        info = tracked_tokens.setdefault(
-            address, {"symbol": None, "chain": None, "subscribers": {}}
-        )
-        ensure_subscriber(info, user_id)
+# Одиночный порог: kind -> (поле ThresholdState, текст запроса, пример)
+_SELECT_META = {
+    "price": ("pending_price_for", "📈 Введи порог изменения цены", "5"),
+    "mcap": ("pending_mcap_for", "🏦 Введи порог изменения капитализации", "10"),
+    "vol": ("pending_volume_for", "🛰 Введи порог изменения объёма m5", "20"),
+}
 
-        state["pending_multi"] = address
-        state["multi_params"] = ["price", "mcap", "vol"]
-        state["multi_step"] = 0
-        pending_threshold_input[user_id] = state
+async def _start_threshold_input(query, user_id: int, address: str, kind: str, configure):
+    """Общий шаг select_*: подписка, состояние ввода, запрос первого порога"""
+    info = tracked_tokens.setdefault(
+        address, {"symbol": None, "chain": None, "subscribers": {}}
+    )
+    ensure_subscriber(info, user_id)
 
-        await query.edit_message_reply_markup(reply_markup=None)
+    state = pending_threshold_input.get(user_id) or ThresholdState()
+    configure(state)
+    put_pending(pending_threshold_input, user_id, state)
 
-        label = format_addr_with_meta(address, info)
+    await query.edit_message_reply_markup(reply_markup=None)
 
-        await query.message.reply_text(
-            f"📈 Введи порог изменения цены в % для {label}.\n"
-            f"Например: 5",
-            reply_markup=main_menu_keyboard(),
-        )
-        return
-
-    if data.startswith("select_price:"):
-        address = data.split(":", 1)[1]
-        info = tracked_tokens.setdefault(
-            address, {"symbol": None, "chain": None, "subscribers": {}}
-        )
-        ensure_subscriber(info, user_id)
+    label = format_addr_with_meta(address, info)
+    _, prompt, example = _SELECT_META[kind]
 
-        state["pending_price_for"] = address
-        pending_threshold_input[user_id] = state
+    await query.message.reply_text(
+        f"{prompt} в % для {label}.\n"
+        f"Например: {example}",
+        reply_markup=main_menu_keyboard(),
+    )
 
-        await query.edit_message_reply_markup(reply_markup=None)
+async def _cb_select_all(update: Update, context: ContextTypes.DEFAULT_TYPE, address: str):
+    query = update.callback_query
 
-        label = format_addr_with_meta(address, info)
+    def configure(state: ThresholdState):
+        state.pending_multi = address
+        state.multi_params = ["price", "mcap", "vol"]
+        state.multi_step = 0
 
-        await query.message.reply_text(
-            f"📈 Введи порог изменения цены в % для {label}.\n"
-            f"Например: 5",
-            reply_markup=main_menu_keyboard(),
-        )
-        return
+    # пороги спрашиваются по очереди, начиная с цены
+    await _start_threshold_input(query, query.from_user.id, address, "price", configure)
 
-    if data.startswith("select_mcap:"):
-        address = data.split(":", 1)[1]
-        info = tracked_tokens.setdefault(
-            address, {"symbol": None, "chain": None, "subscribers": {}}
-        )
-        ensure_subscriber(info, user_id)
+async def _cb_select(update: Update, context: ContextTypes.DEFAULT_TYPE, address: str, kind: str):
+    query = update.callback_query
+    field_name = _SELECT_META[kind][0]
+    await _start_threshold_input(
+        query, query.from_user.id, address, kind,
+        lambda state: setattr(state, field_name, address),
+    )
 
-        state["pending_mcap_for"] = address
-        pending_threshold_input[user_id] = state
+# Меню токена зависит только от адреса (он зашит в callback_data), а разметка
+# в PTB неизменяемая — строим один раз на адрес
+@lru_cache(maxsize=1024)
+def _menu_disabled_keyboard(address: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    "📈 Цена", callback_data=f"select_price:{address}"
+                ),
+                InlineKeyboardButton(
+                    "🏦 Капа", callback_data=f"select_mcap:{address}"
+                ),
+                InlineKeyboardButton(
+                    "🛰 Объём", callback_data=f"select_vol:{address}"
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    "✅ Все три", callback_data=f"select_all:{address}"
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    "🛑 Удалить из списка", callback_data=f"delete:{address}"
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    "⬅️ Назад", callback_data="back_to_watchlist"
+                ),
+            ],
+        ]
+    )
 
-        await query.edit_message_reply_markup(reply_markup=None)
+@lru_cache(maxsize=1024)
+def _menu_keyboard(address: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    "❌ Цена", callback_data=f"disable_price:{address}"
+                ),
+                InlineKeyboardButton(
+                    "❌ Капа", callback_data=f"disable_mcap:{address}"
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    "❌ Объём", callback_data=f"disable_vol:{address}"
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    "📌 Оставить в списке", callback_data=f"pin:{address}"
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    "🛑 Удалить полностью", callback_data=f"delete:{address}"
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    "⬅️ Назад", callback_data="back_to_watchlist"
+                ),
+            ],
+        ]
+    )
 
-        label = format_addr_with_meta(address, info)
+async def _cb_menu_disabled(update: Update, context: ContextTypes.DEFAULT_TYPE, address: str):
+    query = update.callback_query
+    user_id = query.from_user.id
+    info = tracked_tokens.get(address)
 
+    if not info or user_id not in info.get("subscribers", {}):
         await query.message.reply_text(
-            f"🏦 Введи порог изменения капитализации в % для {label}.\n"
-            f"Например: 10",
+            "⚠️ Этот токен больше не отслеживается.",
             reply_markup=main_menu_keyboard(),
         )
         return
 
-    if data.startswith("select_vol:"):
-        address = data.split(":", 1)[1]
-        info = tracked_tokens.setdefault(
-            address, {"symbol": None, "chain": None, "subscribers": {}}
-        )
-        ensure_subscriber(info, user_id)
+    symbol = info.get("symbol", "")
+    short_address = short_addr(address)
 
-        state["pending_volume_for"] = address
-        pending_threshold_input[user_id] = state
+    text = (
+        f"📌 {symbol} {short_address}\n\n"
+        f"⛔ Отслеживание отключено\n\n"
+        f"Выбери параметры для подключения:"
+    )
 
-        await query.edit_message_reply_markup(reply_markup=None)
+    await query.edit_message_text(text=text, reply_markup=_menu_disabled_keyboard(address))
 
-        label = format_addr_with_meta(address, info)
+async def _cb_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, address: str):
+    query = update.callback_query
+    user_id = query.from_user.id
+    info = tracked_tokens.get(address)
 
+    if not info or user_id not in info.get("subscribers", {}):
         await query.message.reply_text(
-            f"🛰 Введи порог изменения объёма m5 в % для {label}.\n"
-            f"Например: 20",
+            "⚠️ Этот токен больше не отслеживается.",
             reply_markup=main_menu_keyboard(),
         )
         return
 
-    if data.startswith("menu_disabled:"):
-        address = data.split(":", 1)[1]
-        info = tracked_tokens.get(address)
-
-        if not info or user_id not in info.get("subscribers", {}):
-            await query.message.reply_text(
-                "⚠️ Этот токен больше не отслеживается.",
-                reply_markup=main_menu_keyboard(),
-            )
-            return
-
-        symbol = info.get("symbol", "")
-        short_address = short_addr(address)
+    sub = info["subscribers"][user_id]
+    symbol = info.get("symbol", "")
+    short_address = short_addr(address)
 
-        text = (
-            f"📌 {symbol} {short_address}\n\n"
-            f"⛔ Отслеживание отключено\n\n"
-            f"Выбери параметры для подключения:"
-        )
-
-        keyboard = InlineKeyboardMarkup(
-            [
-                [
-                    InlineKeyboardButton(
-                        "📈 Цена", callback_data=f"select_price:{address}"
-                    ),
-                    InlineKeyboardButton(
-                        "🏦 Капа", callback_data=f"select_mcap:{address}"
-                    ),
-                    InlineKeyboardButton(
-                        "🛰 Объём", callback_data=f"select_vol:{address}"
-                    ),
-                ],
-                [
-                    InlineKeyboardButton(
-                        "✅ Все три", callback_data=f"select_all:{address}"
-                    ),
-                ],
-                [
-                    InlineKeyboardButton(
-                        "🛑 Удалить из списка", callback_data=f"delete:{address}"
-                    ),
-                ],
-                [
-                    InlineKeyboardButton(
-                        "⬅️ Назад", callback_data="back_to_watchlist"
-                    ),
-                ],
-            ]
-        )
+    vt = sub.get("vol_threshold")
+    pt = sub.get("price_threshold")
+    mt = sub.get("mcap_threshold")
 
-        await query.edit_message_text(text=text, reply_markup=keyboard)
-        return
+    status_lines = [f"📌 **{symbol}** {short_address}"]
+    status_lines.append("")
+    status_lines.append("**ПАРАМЕТРЫ:**")
 
-    if data.startswith("menu:"):
-        address = data.split(":", 1)[1]
-        info = tracked_tokens.get(address)
+    if pt is not None:
+        status_lines.append(f"✅ 📈 Цена: {pt:.1f}%")
+    else:
+        status_lines.append(f"⛔ 📈 Цена: отключена")
 
-        if not info or user_id not in info.get("subscribers", {}):
-            await query.message.reply_text(
-                "⚠️ Этот токен больше не отслеживается.",
-                reply_markup=main_menu_keyboard(),
-            )
-            return
+    if mt is not None:
+        status_lines.append(f"✅ 🏦 Капа: {mt:.1f}%")
+    else:
+        status_lines.append(f"⛔ 🏦 Капа: отключена")
 
-        sub = info["subscribers"][user_id]
-        symbol = info.get("symbol", "")
-        short_address = short_addr(address)
+    if vt is not None:
+        status_lines.append(f"✅ 🛰 Объём: {vt:.1f}%")
+    else:
+        status_lines.append(f"⛔ 🛰 Объём: отключен")
 
-        vt = sub.get("vol_threshold")
-        pt = sub.get("price_threshold")
-        mt = sub.get("mcap_threshold")
+    pump_dump = detect_pump_dump(info.get("volume_history", deque()))
 
-        status_lines = [f"📌 **{symbol}** {short_address}"]
+    if pump_dump:
         status_lines.append("")
-        status_lines.append("**ПАРАМЕТРЫ:**")
-
-        if pt is not None:
-            status_lines.append(f"✅ 📈 Цена: {pt:.1f}%")
-        else:
-            status_lines.append(f"⛔ 📈 Цена: отключена")
-
-        if mt is not None:
-            status_lines.append(f"✅ 🏦 Капа: {mt:.1f}%")
-        else:
-            status_lines.append(f"⛔ 🏦 Капа: отключена")
-
-        if vt is not None:
-            status_lines.append(f"✅ 🛰 Объём: {vt:.1f}%")
-        else:
-            status_lines.append(f"⛔ 🛰 Объём: отключен")
-
-        pump_dump = detect_pump_dump(sub.get("volume_history", deque()))
+        status_lines.append(f"⚡ {pump_dump}")
 
-        if pump_dump:
-            status_lines.append("")
-            status_lines.append(f"⚡ {pump_dump}")
+    text = "\n".join(status_lines)
 
-        text = "\n".join(status_lines)
+    await query.edit_message_text(
+        text=text, reply_markup=_menu_keyboard(address), parse_mode="Markdown"
+    )
 
-        keyboard = InlineKeyboardMarkup(
-            [
-                [
-                    InlineKeyboardButton(
-                        "❌ Цена", callback_data=f"disable_price:{address}"
-                    ),
-                    InlineKeyboardButton(
-                        "❌ Капа", callback_data=f"disable_mcap:{address}"
-                    ),
-                ],
-                [
-                    InlineKeyboardButton(
-                        "❌ Объём", callback_data=f"disable_vol:{address}"
-                    ),
-                ],
-                [
-                    InlineKeyboardButton(
-                        "📌 Оставить в списке", callback_data=f"pin:{address}"
-                    ),
-                ],
-                [
-                    InlineKeyboardButton(
-                        "🛑 Удалить полностью", callback_data=f"delete:{address}"
-                    ),
-                ],
-                [
-                    InlineKeyboardButton(
-                        "⬅️ Назад", callback_data="back_to_watchlist"
-                    ),
-                ],
-            ]
-        )
+async def _cb_pin(update: Update, context: ContextTypes.DEFAULT_TYPE, address: str):
+    query = update.callback_query
+    user_id = query.from_user.id
+    info = tracked_tokens.get(address)
 
-        await query.edit_message_text(text=text, reply_markup=keyboard, parse_mode="Markdown")
+    if not info or user_id not in info.get("subscribers", {}):
+        await query.message.reply_text("⚠️ Токен не найден.")
         return
 
-    if data.startswith("pin:"):
-        address = data.split(":", 1)[1]
-        info = tracked_tokens.get(address)
+    sub = info["subscribers"][user_id]
 
-        if not info or user_id not in info.get("subscribers", {}):
-            await query.message.reply_text("⚠️ Токен не найден.")
-            return
+    sub["vol_threshold"] = None
+    sub["price_threshold"] = None
+    sub["mcap_threshold"] = None
+    schedule_save()
 
-        sub = info["subscribers"][user_id]
+    label = format_addr_with_meta(address, info)
 
-        sub["vol_threshold"] = None
-        sub["price_threshold"] = None
-        sub["mcap_threshold"] = None
+    await query.message.reply_text(
+        f"📌 {label} остался в списке, но все пороги сброшены.",
+        reply_markup=main_menu_keyboard(),
+    )
 
-        label = format_addr_with_meta(address, info)
+async def _cb_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, address: str):
+    query = update.callback_query
+    user_id = query.from_user.id
+    info = tracked_tokens.get(address)
 
-        await query.message.reply_text(
-            f"📌 {label} остался в списке, но все пороги сброшены.",
-            reply_markup=main_menu_keyboard(),
-        )
+    if not info or user_id not in info.get("subscribers", {}):
+        await query.message.reply_text("⚠️ Токен не найден.")
         return
 
-    if data.startswith("delete:"):
-        address = data.split(":", 1)[1]
-        info = tracked_tokens.get(address)
+    label = format_addr_with_meta(address, info)
 
-        if not info or user_id not in info.get("subscribers", {}):
-            await query.message.reply_text("⚠️ Токен не найден.")
-            return
+    info["subscribers"].pop(user_id, None)
 
-        label = format_addr_with_meta(address, info)
+    if not info["subscribers"]:
+        tracked_tokens.pop(address, None)
+    schedule_save()
 
-        info["subscribers"].pop(user_id, None)
+    state = pending_threshold_input.get(user_id)
 
-        if not info["subscribers"]:
-            tracked_tokens.pop(address, None)
+    if state is not None:
+        state.forget(address)
+        put_pending(pending_threshold_input, user_id, state)
 
-        state = pending_threshold_input.get(user_id)
+    await query.message.reply_text(
+        f"🛑 {label} удален из Watchlist.",
+        reply_markup=main_menu_keyboard(),
+    )
 
-        if state:
-            if state.get("pending_volume_for") == address:
-                state["pending_volume_for"] = None
-            if state.get("pending_price_for") == address:
-                state["pending_price_for"] = None
-            if state.get("pending_mcap_for") == address:
-                state["pending_mcap_for"] = None
-            if state.get("pending_multi") == address:
-                state["pending_multi"] = None
-            pending_threshold_input[user_id] = state
+# Отключение одного порога: kind -> (ключ порога подписчика, что отключено)
+_DISABLE_META = {
+    "price": ("price_threshold", "цены"),
+    "mcap": ("mcap_threshold", "капы"),
+    "vol": ("vol_threshold", "объёма"),
+}
+
+async def _cb_disable(update: Update, context: ContextTypes.DEFAULT_TYPE, address: str, kind: str):
+    query = update.callback_query
+    user_id = query.from_user.id
+    info = tracked_tokens.get(address)
 
+    if not info:
         await query.message.reply_text(
-            f"🛑 {label} удален из Watchlist.",
+            "⚠️ Этот токен уже не отслеживается.",
             reply_markup=main_menu_keyboard(),
         )
         return
 
-    if data == "back_to_watchlist":
-        await watchlist(update, context)
-        return
-
-    if data.startswith("disable_"):
-        prefix, address = data.split(":", 1)
-        kind = prefix.replace("disable_", "")
-
-        info = tracked_tokens.get(address)
+    subs = info.get("subscribers", {})
+    sub = subs.get(user_id)
 
-        if not info:
-            await query.message.reply_text(
-                "⚠️ Этот токен уже не отслеживается.",
-                reply_markup=main_menu_keyboard(),
-            )
-            return
+    if not sub:
+        await query.message.reply_text(
+            "⚠️ Подписка для этого токена уже снята.",
+            reply_markup=main_menu_keyboard(),
+        )
+        return
 
-        subs = info.get("subscribers", {})
-        sub = subs.get(user_id)
+    label = format_addr_with_meta(address, info)
+    schedule_save()
 
-        if not sub:
-            await query.message.reply_text(
-                "⚠️ Подписка для этого токена уже снята.",
-                reply_markup=main_menu_keyboard(),
-            )
-            return
+    meta = _DISABLE_META.get(kind)
+    if meta is not None:
+        threshold_key, what = meta
+        sub[threshold_key] = None
+        await query.message.reply_text(
+            f"✅ Отключены алерты {what} для {label}.",
+            reply_markup=main_menu_keyboard(),
+        )
 
-        label = format_addr_with_meta(address, info)
+    elif kind == "all":
+        subs.pop(user_id, None)
 
-        if kind == "price":
-            sub["price_threshold"] = None
-            await query.message.reply_text(
-                f"✅ Отключены алерты цены для {label}.",
-                reply_markup=main_menu_keyboard(),
-            )
+        if not subs:
+            tracked_tokens.pop(address, None)
 
-        elif kind == "mcap":
-            sub["mcap_threshold"] = None
-            await query.message.reply_text(
-                f"✅ Отключены алерты капы для {label}.",
-                reply_markup=main_menu_keyboard(),
-            )
+        await query.message.reply_text(
+            f"🛑 Полностью отключено отслеживание {label}.",
+            reply_markup=main_menu_keyboard(),
+        )
 
-        elif kind == "vol":
-            sub["vol_threshold"] = None
-            await query.message.reply_text(
-                f"✅ Отключены алерты объёма для {label}.",
-                reply_markup=main_menu_keyboard(),
-            )
+async def _cb_askai(update: Update, context: ContextTypes.DEFAULT_TYPE, address: str):
+    query = update.callback_query
+    info = tracked_tokens.get(address, {})
+    label = format_addr_with_meta(address, info)
 
-        elif kind == "all":
-            subs.pop(user_id, None)
+    context.user_data["last_token_addr"] = address
+    context.user_data["awaiting_ai_question"] = True
 
-            if not subs:
-                tracked_tokens.pop(address, None)
+    await query.message.reply_text(
+        f"🤖 ИИ будет учитывать токен {label}.\n"
+        f"Теперь просто напиши свой вопрос (можно без /ai).\n"
+        f"Например: `проанализируй этот токен и сравни с моим портфелем`.",
+        parse_mode="Markdown",
+        reply_markup=main_menu_keyboard(),
+    )
 
-            await query.message.reply_text(
-                f"🛑 Полностью отключено отслеживание {label}.",
-                reply_markup=main_menu_keyboard(),
-            )
+# Кнопки вида "prefix:arg": prefix -> обработчик, arg передаётся третьим аргументом
+CB_PREFIX_HANDLERS = {
+    "wallet_delete": _cb_wallet_delete,
+    "select_all": _cb_select_all,
+    "select_price": partial(_cb_select, kind="price"),
+    "select_mcap": partial(_cb_select, kind="mcap"),
+    "select_vol": partial(_cb_select, kind="vol"),
+    "menu_disabled": _cb_menu_disabled,
+    "menu": _cb_menu,
+    "pin": _cb_pin,
+    "delete": _cb_delete,
+    "disable_price": partial(_cb_disable, kind="price"),
+    "disable_mcap": partial(_cb_disable, kind="mcap"),
+    "disable_vol": partial(_cb_disable, kind="vol"),
+    "disable_all": partial(_cb_disable, kind="all"),
+    "askai": _cb_askai,
+}
 
-    if data.startswith("askai:"):
-        address = data.split(":", 1)[1]
-        info = tracked_tokens.get(address, {})
-        label = format_addr_with_meta(address, info)
+@serialized_per_user
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data or ""
+    user_id = query.from_user.id
 
-        context.user_data["last_token_addr"] = address
-        context.user_data["awaiting_ai_question"] = True
+    logger.info("BTN от %s: %s", user_id, data)
 
-        await query.message.reply_text(
-            f"🤖 ИИ будет учитывать токен {label}.\n"
-            f"Теперь просто напиши свой вопрос (можно без /ai).\n"
-            f"Например: `проанализируй этот токен и сравни с моим портфелем`.",
-            parse_mode="Markdown",
-            reply_markup=main_menu_keyboard(),
-        )
+    try:
+        await query.answer()
+    except TelegramError:
+        # запрос мог устареть, пока ждали lock пользователя — кнопку всё равно обрабатываем
+        logger.debug("query.answer failed for %s", user_id, exc_info=True)
+
+    handler = CALLBACK_HANDLERS.get(data)
+    if handler:
+        await handler(update, context)
         return
 
+    # "prefix:arg" разбираем один раз, обработчик ищем по prefix
+    prefix, _, arg = data.partition(":")
+    handler = CB_PREFIX_HANDLERS.get(prefix)
+    if handler:
+        await handler(update, context, arg)
+
 # ============ MAIN ============
 
 def main():
@@ -1692,9 +2381,31 @@ def main():
         logger.error("❌ BOT_TOKEN не установлен в .env!")
         return
 
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("❌ WEBHOOK_SECRET не установлен в .env — вебхук без него не запускаю!")
+        return
+
     logger.info("🚀 Запускаю крипто-бота...")
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    load_data()
+
+    if uvloop is not None:
+        uvloop.install()
+
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .connect_timeout(TELEGRAM_CONNECT_TIMEOUT)
+        .read_timeout(TELEGRAM_READ_TIMEOUT)
+        .pool_timeout(TELEGRAM_POOL_TIMEOUT)
+        # очередь исходящих запросов: не больше 30 сообщений/сек на бота,
+        # при 429 ждём retry_after и повторяем
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Команды
     app.add_handler(CommandHandler("start", start))
@@ -1704,6 +2415,12 @@ def main():
     app.add_handler(CommandHandler("watchlist", watchlist))
     app.add_handler(CommandHandler("unwatch", unwatch))
 
+    # Фоновые задачи
+    app.job_queue.run_repeating(
+        reap_pending_states, interval=PENDING_REAP_INTERVAL, first=PENDING_REAP_INTERVAL
+    )
+    app.job_queue.run_repeating(refresh_caches, interval=CACHE_REFRESH_INTERVAL, first=5)
+
     # Callback'ы
     app.add_handler(CallbackQueryHandler(ai_callback, pattern="^ai:"))
     app.add_handler(CallbackQueryHandler(button_callback))
@@ -1715,7 +2432,23 @@ def main():
     logger.info("✅ БОТ ИНИЦИАЛИЗИРОВАН И ГОТОВ К РАБОТЕ!")
     logger.info("=" * 70)
 
-    app.run_polling()
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            # токен бота в путь не кладём — он попал бы в логи прокси
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        # long polling: Telegram держит запрос открытым до POLLING_TIMEOUT сек
+        app.run_polling(allowed_updates=ALLOWED_UPDATES, timeout=POLLING_TIMEOUT)
+
+    # дописываем изменения, которые не успел сбросить отложенный таймер
+    flush_data()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+# Общий кэш ответов внешних API (DexScreener, CoinGecko, Moralis)
+CACHE_MAX_ENTRIES = 4096
+
+# Кэш: ключ -> (момент истечения по time.monotonic(), данные)
+_cache: dict[tuple, tuple[float, object]] = {}
+
+# Запросы, которые сейчас выполняются: одинаковые параллельные вызовы ждут один ответ
+_inflight: dict[tuple, asyncio.Future] = {}
+
+# Валидаторы HTTP-ответов для условных GET: ключ -> (момент истечения, ETag,
+# Last-Modified, данные). Живут дольше TTL кэша, но не бесконечно: вместе с ними
+# хранится весь ответ, поэтому и число записей, и их возраст ограничены
+VALIDATORS_MAX_ENTRIES = 256
+VALIDATOR_MAX_AGE = 300
+_validators: dict[tuple, tuple[float, str | None, str | None, object]] = {}
+
+# Метка закэшированной неудачи (fetch вернул None)
+_NEGATIVE = object()
+
+
+def cache_get(key: tuple):
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    expires_at, data = entry
+    if expires_at <= time.monotonic():
+        _cache.pop(key, None)
+        return None
+    return data
+
+
+def cache_set(key: tuple, data, ttl: float):
+    now = time.monotonic()
+    if len(_cache) >= CACHE_MAX_ENTRIES:
+        for k in [k for k, (exp, _) in _cache.items() if exp <= now]:
+            del _cache[k]
+        if len(_cache) >= CACHE_MAX_ENTRIES:
+            # dict хранит порядок вставки — выкидываем самую старую запись
+            _cache.pop(next(iter(_cache)))
+    _cache[key] = (now + ttl, data)
+
+
+def validators(key: tuple) -> tuple[dict, object]:
+    """
+    Заголовки If-None-Match / If-Modified-Since для повторного запроса по ключу
+    и данные, которые они подтверждают. Данные берутся сразу: на ответ 304
+    вызывающий отдаёт их, даже если запись успели вытеснить, пока шёл запрос.
+    Нет валидаторов — ({}, None)
+    """
+    entry = _validators.get(key)
+    if entry is None:
+        return {}, None
+    expires_at, etag, last_modified, data = entry
+    if expires_at <= time.monotonic():
+        del _validators[key]
+        return {}, None
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers, data
+
+
+def remember_validators(key: tuple, headers, data):
+    """Запоминает ETag / Last-Modified ответа, если сервер их прислал"""
+    etag = headers.get("ETag")
+    last_modified = headers.get("Last-Modified")
+    # свежая запись уходит в конец — вытесняется самая давно обновлённая
+    _validators.pop(key, None)
+    # без данных ответить на 304 будет нечем
+    if (not etag and not last_modified) or data is None:
+        return
+    while len(_validators) >= VALIDATORS_MAX_ENTRIES:
+        _validators.pop(next(iter(_validators)))
+    _validators[key] = (time.monotonic() + VALIDATOR_MAX_AGE, etag, last_modified, data)
+
+
+async def cached(key: tuple, ttl: float, fetch, negative_ttl: float = 0):
+    """
+    Возвращает результат fetch() (корутина без аргументов) с кэшем и объединением
+    одинаковых запросов: если запрос с тем же ключом уже в полёте, ждём его
+    результат вместо второго HTTP-вызова.
+    ttl > 0 — результат, отличный от None, кэшируется на ttl секунд.
+    negative_ttl > 0 — None (ошибка/нет данных) тоже кэшируется, на negative_ttl секунд,
+    чтобы повторы одного неудачного запроса не уходили в сеть.
+    """
+    if ttl or negative_ttl:
+        data = cache_get(key)
+        if data is _NEGATIVE:
+            return None
+        if data is not None:
+            return data
+
+    while (fut := _inflight.get(key)) is not None:
+        # asyncio.wait не отменяет fut, если отменят ждущего, и не бросает
+        # CancelledError, если отменили ведущий запрос
+        await asyncio.wait((fut,))
+        if not fut.cancelled():
+            return fut.result()
+        # ведущий вызов отменён, а этот нет: повторяем запрос сами
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        data = await fetch()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        # ошибку получит сам вызывающий; ждущих может и не быть
+        fut.exception()
+        raise
+    finally:
+        _inflight.pop(key, None)
+
+    if ttl and data is not None:
+        cache_set(key, data, ttl)
+    elif negative_ttl and data is None:
+        cache_set(key, _NEGATIVE, negative_ttl)
+    fut.set_result(data)
+    return data